@@ -0,0 +1,251 @@
+import sys
+import math
+
+import picoCam
+import kernels
+from picoCam import Camera, ESP32Relay, FileSink, StreamSink, Pin, SPI, utime, uos, ujson
+
+try:
+    import machine
+    ON_BOARD = True
+except ImportError:
+    import simcam
+    ON_BOARD = False
+
+'''
+Throughput benchmark, runs on the board and on host CPython against simcam
+* Sweeps every resolution of the detected sensor, the burst chunk sizes and the sinks
+  memory (chunks copied to RAM), flash (FileSink) and relay (ESP32Relay.stream_pipelined, framed protocol)
+* Each configuration appends one JSON line to output with min/mean/p50/p90/p99/max of
+    capture_ms  trigger to capture done, for relay only the wait left after the previous frame was sent
+    fifo_mbps   FIFO burst read rate
+    link_mbps   ESP32 link write rate (relay only)
+    fps         end to end frames per second
+* compare(baseline, current) lists the metrics that got worse by more than tolerance, native in each record
+  shows whether the viper kernels were used (see kernels.py)
+
+    import bench
+    bench.run(frames=10, label='build-42')
+    bench.compare('baseline.jsonl', 'bench_results.jsonl')
+
+From a shell on the host: python bench.py [frames] [output] or python bench.py compare baseline.jsonl current.jsonl
+'''
+CHUNK_SIZES = (256, 512, 1024, 2048)
+SINKS = ('memory', 'flash', 'relay')
+PERCENTILES = (50, 90, 99)
+
+# Metric -> True when a larger value is better
+METRICS = {
+    'capture_ms': False,
+    'fifo_mbps': True,
+    'link_mbps': True,
+    'fps': True
+}
+
+FLASH_FILENAME = 'bench.jpg'
+
+
+# Copies each chunk into one chunk sized buffer, the cost of handling the data without keeping the image
+class ScratchSink(StreamSink):
+    def __init__(self, size):
+        self.buffer_mv = memoryview(bytearray(size))
+
+    def write(self, chunk):
+        self.buffer_mv[:len(chunk)] = chunk
+
+
+def summarise(samples):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    summary = {
+        'min': ordered[0],
+        'mean': sum(ordered) / len(ordered),
+        'max': ordered[-1]
+    }
+    for p in PERCENTILES:
+        summary['p{}'.format(p)] = ordered[min(len(ordered) - 1, int(math.ceil(p / 100 * len(ordered))) - 1)]
+    return summary
+
+
+def _mbps(length, us):
+    if us <= 0:
+        return None
+    return length / us
+
+
+'''
+Pins and buses as wired at the bottom of picoCam.py, on the host sensor picks the simulated sensor
+* One relay serves every chunk size, the RP2040 can only start one link worker on the second core
+'''
+def setup(max_chunk, sensor='3MP'):
+    if not ON_BOARD:
+        sensor_id = simcam.SimArduCam.SENSOR_5MP if sensor == '5MP' else simcam.SimArduCam.SENSOR_3MP
+        simcam.board.attach(0, 17, simcam.SimArduCam(sensor_id=sensor_id))
+        simcam.board.attach(1, 13, simcam.SimESP32())
+
+    esp32SPI = SPI(1, baudrate=8000000, polarity=0, phase=1, bits=8, sck=Pin(10), mosi=Pin(11), miso=Pin(12))
+    esp32CS = Pin(13, Pin.OUT)
+    esp32CS.high()
+    camSPI = SPI(0, sck=Pin(18), miso=Pin(16), mosi=Pin(19), baudrate=8000000)
+    camCS = Pin(17, Pin.OUT)
+
+    relay = ESP32Relay(esp32SPI, esp32CS, max_chunk, dual_core=True, link_protocol=ESP32Relay.PROTOCOL_FRAMED)
+    return camSPI, camCS, relay
+
+
+def _sequential_frames(cam, sink, frames):
+    samples = {'capture_ms': [], 'fifo_mbps': [], 'fps': []}
+    bytes_sent = 0
+    for i in range(frames):
+        start_frame = utime.ticks_us()
+        cam.capture_jpg()
+        captured = utime.ticks_us()
+        fifo_length = cam.received_length
+        # Nothing was captured (white balance still settling), scoring it would report an empty frame rate
+        if fifo_length == 0:
+            continue
+        bytes_sent += cam.stream_fifo(sink)
+        end_frame = utime.ticks_us()
+
+        samples['capture_ms'].append(utime.ticks_diff(captured, start_frame) / 1000)
+        samples['fifo_mbps'].append(_mbps(fifo_length - cam.received_length, cam.fifo_read_us))
+        samples['fps'].append(1000000 / max(1, utime.ticks_diff(end_frame, start_frame)))
+    return samples, bytes_sent
+
+
+def _relay_frames(cam, relay, frames):
+    samples = {'capture_ms': [], 'fifo_mbps': [], 'link_mbps': [], 'fps': []}
+    bytes_sent = 0
+    start_frame = utime.ticks_us()
+    for image_bytes in relay.stream_pipelined(cam):
+        end_frame = utime.ticks_us()
+        samples['capture_ms'].append(cam.last_capture_wait_us / 1000)
+        samples['fifo_mbps'].append(_mbps(image_bytes, cam.fifo_read_us))
+        samples['link_mbps'].append(_mbps(image_bytes, relay.link_write_us))
+        samples['fps'].append(1000000 / max(1, utime.ticks_diff(end_frame, start_frame)))
+        bytes_sent += image_bytes
+        start_frame = end_frame
+        if len(samples['fps']) == frames:
+            break
+    return samples, bytes_sent
+
+
+def run_config(cam, relay, resolution, sink_name, frames=10, warmup=1):
+    cam.resolution = resolution
+    if sink_name == 'memory':
+        sink = ScratchSink(cam.burst_length)
+        _sequential_frames(cam, sink, warmup)
+        samples, bytes_sent = _sequential_frames(cam, sink, frames)
+    elif sink_name == 'flash':
+        sink = FileSink(FLASH_FILENAME)
+        _sequential_frames(cam, sink, warmup)
+        samples, bytes_sent = _sequential_frames(cam, sink, frames)
+        uos.remove(FLASH_FILENAME)
+    elif sink_name == 'relay':
+        _relay_frames(cam, relay, warmup)
+        samples, bytes_sent = _relay_frames(cam, relay, frames)
+    else:
+        raise ValueError("Unknown sink {}, please select from {}".format(sink_name, SINKS))
+
+    record = {
+        'sensor': cam.camera_idx,
+        'resolution': resolution,
+        'chunk': cam.burst_length,
+        'sink': sink_name,
+        'frames': len(samples['fps']),
+        'mean_bytes': bytes_sent // max(1, len(samples['fps'])),
+        'native': kernels.NATIVE
+    }
+    for metric in METRICS:
+        values = [value for value in samples.get(metric, []) if value is not None]
+        record[metric] = summarise(values)
+    return record
+
+
+'''
+Runs every configuration and appends the results to output, returns the records
+* resolutions defaults to every resolution of the detected sensor
+'''
+def run(frames=10, chunk_sizes=CHUNK_SIZES, sinks=SINKS, resolutions=None, output='bench_results.jsonl',
+        label=None, sensor='3MP', warmup=1):
+    if label is None:
+        label = sys.platform
+    records = []
+    camSPI, camCS, relay = setup(max(chunk_sizes), sensor)
+    for chunk in chunk_sizes:
+        cam = Camera(camSPI, camCS, fast_start=True, burst_length=chunk)
+        if resolutions is None:
+            valid = cam.valid_5mp_resolutions if cam.camera_idx == '5MP' else cam.valid_3mp_resolutions
+            config_resolutions = sorted(valid, key=lambda r: valid[r])
+        else:
+            config_resolutions = resolutions
+        for resolution in config_resolutions:
+            for sink_name in sinks:
+                record = run_config(cam, relay, resolution, sink_name, frames, warmup)
+                record['label'] = label
+                record['platform'] = sys.platform
+                records.append(record)
+                _print_record(record)
+                with open(output, 'a') as f:
+                    f.write(ujson.dumps(record) + '\n')
+    return records
+
+
+def _print_record(record):
+    line = '{} {} {:>9} {:>5} {:<6}'.format(record['label'], record['sensor'], record['resolution'], record['chunk'], record['sink'])
+    for metric in METRICS:
+        summary = record[metric]
+        if summary is not None:
+            line += ' {} p50 {:.2f} p99 {:.2f}'.format(metric, summary['p50'], summary['p99'])
+    print(line)
+
+
+def load(path):
+    records = {}
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                record = ujson.loads(line)
+                # A later run of the same configuration replaces the earlier one
+                records[(record['sensor'], record['resolution'], record['chunk'], record['sink'])] = record
+    return records
+
+
+'''
+Compares the p50 of every metric between two result files
+* Returns (configuration, metric, baseline, current) for each metric that is worse by more than tolerance
+'''
+def compare(baseline_path, current_path, tolerance=0.1):
+    baseline = load(baseline_path)
+    current = load(current_path)
+    regressions = []
+    for key in current:
+        if key not in baseline:
+            continue
+        for metric in METRICS:
+            old = baseline[key][metric]
+            new = current[key][metric]
+            if old is None or new is None:
+                continue
+            old = old['p50']
+            new = new['p50']
+            if METRICS[metric]:
+                worse = new < old * (1 - tolerance)
+            else:
+                worse = new > old * (1 + tolerance)
+            if worse:
+                regressions.append((key, metric, old, new))
+                print('regression {} {}: {:.3f} -> {:.3f}'.format(key, metric, old, new))
+    return regressions
+
+
+if __name__ == '__main__':
+    args = getattr(sys, 'argv', [])[1:]
+    if args and args[0] == 'compare':
+        if compare(*args[1:3]):
+            sys.exit(1)
+    else:
+        frames = int(args[0]) if args else 10
+        output = args[1] if len(args) > 1 else 'bench_results.jsonl'
+        run(frames=frames, output=output)
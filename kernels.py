@@ -0,0 +1,85 @@
+from array import array
+
+'''
+Byte loops of the hot paths, compiled to machine code by MicroPython's viper emitter on the board
+* kernels_viper holds the viper versions, it is picked at import time when it compiles (NATIVE is then True).
+  Any error while importing it (no native emitter, a viper limit of the firmware) falls back
+* The pure Python versions below give the same results, they run on host CPython and on ports built
+  without the native emitters
+* The viper versions read through raw pointers without bounds checks, callers keep indexes inside the buffer
+
+find_marker(buffer, start, end, marker)
+    index of the first 0xFF followed by marker in buffer[start:end], -1 if there is none
+crc32(data, crc=0)
+    CRC-32 (IEEE, same as binascii.crc32), crc continues an earlier result
+block_luma_sums(buffer, width, height, stride, block, sums)
+    sums the Y bytes of a YUV 4:2:2 frame (every second byte) over block x block tiles into sums,
+    an array('l') of (width // block) * (height // block) tiles in row order
+'''
+CRC_POLYNOMIAL = 0xEDB88320
+
+# 'I' is 32 bits on the RP2040 and on host CPython, the viper CRC reads the table as ptr32
+CRC_TABLE = array('I', [0] * 256)
+for _n in range(256):
+    _c = _n
+    for _k in range(8):
+        _c = (_c >> 1) ^ CRC_POLYNOMIAL if _c & 1 else _c >> 1
+    CRC_TABLE[_n] = _c
+
+
+def _find_marker(buffer, start, end, marker):
+    # Index of the 0xFF that starts the two byte marker, -1 if not found
+    end -= 1
+    while start < end:
+        if buffer[start] == 0xFF and buffer[start + 1] == marker:
+            return start
+        start += 1
+    return -1
+
+
+def _crc32(data, crc=0):
+    crc ^= 0xFFFFFFFF
+    for byte in data:
+        crc = CRC_TABLE[(crc ^ byte) & 0xFF] ^ (crc >> 8)
+    return crc ^ 0xFFFFFFFF
+
+
+def _block_luma_sums(buffer, width, height, stride, block, sums):
+    blocks_x = width // block
+    span = 2 * block
+    for i in range(len(sums)):
+        sums[i] = 0
+    for y in range(height):
+        row_start = y * stride
+        base = (y // block) * blocks_x
+        for bx in range(blocks_x):
+            start = row_start + bx * span
+            total = 0
+            for i in range(start, start + span, 2):
+                total += buffer[i]
+            sums[base + bx] += total
+
+
+try:
+    import kernels_viper
+
+    def crc32(data, crc=0):
+        return kernels_viper.crc32_update(data, len(data), crc ^ 0xFFFFFFFF, CRC_TABLE) ^ 0xFFFFFFFF
+
+    _geometry = array('l', [0, 0, 0, 0])
+
+    def block_luma_sums(buffer, width, height, stride, block, sums):
+        _geometry[0] = width // block
+        _geometry[1] = height // block
+        _geometry[2] = stride
+        _geometry[3] = block
+        kernels_viper.block_luma_sums(buffer, _geometry, sums)
+
+    find_marker = kernels_viper.find_marker
+    NATIVE = True
+# Without the native emitters kernels_viper raises SyntaxError, a viper limit ViperTypeError or others
+except Exception:
+    find_marker = _find_marker
+    crc32 = _crc32
+    block_luma_sums = _block_luma_sums
+    NATIVE = False
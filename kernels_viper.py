@@ -0,0 +1,73 @@
+import micropython
+
+'''
+Viper versions of the kernels, import kernels instead of this module
+* Nothing is bounds checked, the callers keep indexes inside the buffers (see kernels)
+* Older firmware takes at most 4 viper arguments, wider calls pass a preallocated array('l')
+* Viper has no integer division, kernels passes whole tile counts
+'''
+
+
+@micropython.viper
+def find_marker(buffer, start: int, end: int, marker: int) -> int:
+    buf = ptr8(buffer)
+    end -= 1
+    while start < end:
+        if buf[start] == 0xFF:
+            if buf[start + 1] == marker:
+                return start
+        start += 1
+    return -1
+
+
+# crc is the running value before the final inversion, kernels.crc32 inverts it
+@micropython.viper
+def crc32_update(data, length: int, crc: uint, table) -> uint:
+    buf = ptr8(data)
+    tab = ptr32(table)
+    mask = uint(0xFF)
+    shift = uint(8)
+    i = 0
+    while i < length:
+        index = int((crc ^ uint(buf[i])) & mask)
+        crc = uint(tab[index]) ^ (crc >> shift)
+        i += 1
+    return crc
+
+
+# geometry is array('l', [blocks_x, blocks_y, stride, block])
+@micropython.viper
+def block_luma_sums(buffer, geometry, sums):
+    buf = ptr8(buffer)
+    out = ptr32(sums)
+    shape = ptr32(geometry)
+    blocks_x = shape[0]
+    blocks_y = shape[1]
+    stride = shape[2]
+    block = shape[3]
+    span = 2 * block
+    i = 0
+    while i < blocks_x * blocks_y:
+        out[i] = 0
+        i += 1
+
+    y = 0
+    by = 0
+    while by < blocks_y:
+        base = by * blocks_x
+        r = 0
+        while r < block:
+            row_start = y * stride
+            bx = 0
+            while bx < blocks_x:
+                start = row_start + bx * span
+                end = start + span
+                total = 0
+                while start < end:
+                    total += buf[start]
+                    start += 2
+                out[base + bx] = out[base + bx] + total
+                bx += 1
+            r += 1
+            y += 1
+        by += 1
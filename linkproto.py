@@ -0,0 +1,467 @@
+try:
+    import ustruct as struct
+except ImportError:
+    import struct
+
+try:
+    from binascii import crc32
+except ImportError:
+    # Firmware built without binascii.crc32
+    from kernels import crc32
+
+'''
+Framed link protocol between the Pico and the ESP32 (version 1)
+
+Every SPI transaction (one CS frame) is one message, a 16 byte header followed by the payload
+* magic, version, type, flags (1 byte each), frame id, chunk index, payload length, arg (u16 each), crc32 (u32)
+* Little endian, the CRC covers the first 12 header bytes and the payload
+
+Pico -> ESP32
+* START  payload <IH: FIFO length (upper bound of the image size), chunk size
+* CHUNK  chunk_index numbers the image chunks of the frame from 0
+* END    payload <IH: image length, number of chunks
+* arg of START and END is the stream the frame belongs to (e.g. preview or still), 0 for a single stream
+* POLL   no payload, only clocks out a status
+* TELEMETRY  a JSON telemetry snapshot, sent between frames and not acknowledged
+
+ESP32 -> Pico, clocked out during every transaction
+* STATUS describes the receiver before it handled the message sent in the same transaction
+  flags READY (can take a new frame) and FRAME_OK (frame_id was received complete)
+  chunk_index is the number of chunks received in order, arg is a chunk to resend or NO_CHUNK
+  Each NACK is reported once, a chunk that fails again is NACKed again
+* A START asking for a larger chunk size than the ESP32 can take is ignored and the next STATUS has the
+  CHUNK_LIMIT flag with the largest chunk size in arg instead of a NACK, the sender retries with that size
+'''
+MAGIC = 0xA5
+VERSION = 1
+
+HEADER_FORMAT = '<BBBBHHHH'
+CRC_OFFSET = 12
+HEADER_SIZE = 16
+
+TYPE_START = 1
+TYPE_CHUNK = 2
+TYPE_END = 3
+TYPE_POLL = 4
+TYPE_TELEMETRY = 5
+TYPE_STATUS = 0x81
+
+FLAG_READY = 0x01
+FLAG_FRAME_OK = 0x02
+FLAG_CHUNK_LIMIT = 0x04
+
+NO_CHUNK = 0xFFFF
+
+CONTROL_FORMAT = '<IH'
+CONTROL_PAYLOAD_SIZE = 6
+
+
+class LinkError(Exception):
+    pass
+
+
+# The payload must already be in buffer[HEADER_SIZE:], returns the message length
+def pack_message(buffer, msg_type, flags, frame_id, chunk_index, payload_length, arg=0):
+    struct.pack_into(HEADER_FORMAT, buffer, 0, MAGIC, VERSION, msg_type, flags, frame_id, chunk_index, payload_length, arg)
+    message = memoryview(buffer)
+    crc = crc32(message[HEADER_SIZE:HEADER_SIZE + payload_length], crc32(message[:CRC_OFFSET]))
+    struct.pack_into('<I', buffer, CRC_OFFSET, crc)
+    return HEADER_SIZE + payload_length
+
+
+# (type, flags, frame_id, chunk_index, payload_length, arg), or None if it is not a valid message
+def unpack_message(buffer, length=None):
+    if length is None:
+        length = len(buffer)
+    if length < HEADER_SIZE:
+        return None
+    magic, version, msg_type, flags, frame_id, chunk_index, payload_length, arg = struct.unpack_from(HEADER_FORMAT, buffer, 0)
+    if magic != MAGIC or version != VERSION or HEADER_SIZE + payload_length > length:
+        return None
+    message = memoryview(buffer)
+    crc = crc32(message[HEADER_SIZE:HEADER_SIZE + payload_length], crc32(message[:CRC_OFFSET]))
+    if crc != struct.unpack_from('<I', buffer, CRC_OFFSET)[0]:
+        return None
+    return msg_type, flags, frame_id, chunk_index, payload_length, arg
+
+
+'''
+Sends frames over SPI, the Pico side of the protocol
+* The last window chunks are kept so a NACKed chunk can be resent on its own, sending waits (polls)
+  while the oldest chunk the ESP32 has not received in order would drop out of the window
+* begin_frame() repeats START until a STATUS sent after it shows the ESP32 started the frame. A STATUS
+  describes the ESP32 before the message of its own transaction, so START is followed by a POLL. When the
+  ESP32 reports CHUNK_LIMIT instead, the chunk size shrinks to it (peer_max_chunk) and START is sent again
+  before any chunk
+'''
+class LinkSender:
+    def __init__(self, spi_bus, cs, chunk_size=1024, window=4, max_polls=1000):
+        self.spi_bus = spi_bus
+        self.cs = cs
+        self.window = window
+        self.max_polls = max_polls
+        self.peer_max_chunk = None
+
+        self._message_lengths = [0] * window
+        self._control = bytearray(HEADER_SIZE + CONTROL_PAYLOAD_SIZE)
+        self._telemetry = None
+        self.set_chunk_size(chunk_size)
+
+        self.frame_id = 0
+        self.chunk_index = 0
+        self.acked = 0
+        self.ready = False
+        self.frame_ok = False
+        # Frame id of the last valid STATUS without CHUNK_LIMIT
+        self.status_frame_id = None
+        self._length_hint = 0
+        self.stream = 0
+
+        # Counters for the last frame
+        self.starts_unconfirmed = 0
+        self.chunks_sent = 0
+        self.retransmissions = 0
+        self.polls = 0
+
+    # Reallocates the message buffers, only between frames
+    def set_chunk_size(self, chunk_size):
+        self.chunk_size = chunk_size
+        self._messages = []
+        for i in range(self.window):
+            self._messages.append(bytearray(HEADER_SIZE + chunk_size))
+        self._message_mvs = [memoryview(message) for message in self._messages]
+        self._rx = bytearray(HEADER_SIZE + chunk_size)
+        self._rx_mv = memoryview(self._rx)
+        self._telemetry = None
+
+    # Waits as long as the ESP32 is busy, raises LinkError after max_polls STARTs it reported READY for but did not take
+    def begin_frame(self, length_hint, stream=0):
+        self.new_frame(length_hint, stream)
+        while not self.send_start():
+            self.check_start()
+
+    # begin_frame() in steps, so a cooperative caller can yield between START attempts and call check_start()
+    def new_frame(self, length_hint, stream=0):
+        self.frame_id = (self.frame_id + 1) & 0xFFFF
+        self.stream = stream
+        self.chunk_index = 0
+        self.acked = 0
+        self.chunks_sent = 0
+        self.retransmissions = 0
+        self.polls = 0
+        self.starts_unconfirmed = 0
+        self.frame_ok = False
+
+        self._length_hint = length_hint
+
+    def check_start(self):
+        if self.starts_unconfirmed == self.max_polls:
+            raise LinkError("START of frame {} was not confirmed after {} attempts".format(self.frame_id, self.starts_unconfirmed))
+
+    def send_start(self):
+        if self.peer_max_chunk is not None and self.chunk_size > self.peer_max_chunk:
+            # The buffers stay allocated at the larger size
+            self.chunk_size = self.peer_max_chunk
+        struct.pack_into(CONTROL_FORMAT, self._control, HEADER_SIZE, self._length_hint, self.chunk_size)
+        length = pack_message(self._control, TYPE_START, 0, self.frame_id, 0, CONTROL_PAYLOAD_SIZE, self.stream)
+        self._transfer(self._control, length)
+        if not self.ready:
+            # The ESP32 was still busy and ignored START
+            return False
+
+        self.status_frame_id = None
+        self.poll()
+        if self.status_frame_id == self.frame_id:
+            return True
+        self.starts_unconfirmed += 1
+        return False
+
+    def send_chunk(self, chunk):
+        length = len(chunk)
+        if length > self.chunk_size:
+            raise ValueError("Chunk of {} bytes is larger than the {} byte chunk size".format(length, self.chunk_size))
+
+        polls = 0
+        while self.chunk_index - self.acked >= self.window:
+            if polls == self.max_polls:
+                raise LinkError("Chunk {} of frame {} was not acknowledged after {} polls".format(self.acked, self.frame_id, polls))
+            polls += 1
+            if polls % 16 == 0:
+                # Every chunk after it may have been lost too, so there is no gap for the ESP32 to NACK
+                self._resend(self.acked)
+            else:
+                self.poll()
+        self.polls += polls
+
+        slot = self.chunk_index % self.window
+        message = self._message_mvs[slot]
+        message[HEADER_SIZE:HEADER_SIZE + length] = chunk
+        self._message_lengths[slot] = pack_message(message, TYPE_CHUNK, 0, self.frame_id, self.chunk_index, length)
+        self.chunk_index += 1
+        self.chunks_sent += 1
+        self._transfer(message, self._message_lengths[slot])
+
+    # Sends END then polls until the ESP32 has the whole frame, resending any NACKed chunks
+    def end_frame(self, payload_length):
+        struct.pack_into(CONTROL_FORMAT, self._control, HEADER_SIZE, payload_length, self.chunk_index)
+        length = pack_message(self._control, TYPE_END, 0, self.frame_id, 0, CONTROL_PAYLOAD_SIZE, self.stream)
+        self._transfer(self._control, length)
+
+        polls = 0
+        while not self.frame_ok:
+            if polls == self.max_polls:
+                raise LinkError("Frame {} was not acknowledged after {} polls".format(self.frame_id, polls))
+            polls += 1
+            if polls % 16 == 0:
+                # END itself may have been lost
+                length = pack_message(self._control, TYPE_END, 0, self.frame_id, 0, CONTROL_PAYLOAD_SIZE, self.stream)
+                self._transfer(self._control, length)
+            else:
+                self.poll()
+        self.polls += polls
+
+    # Best effort, a corrupted snapshot is dropped by the ESP32 and the next one replaces it
+    def send_telemetry(self, payload):
+        length = len(payload)
+        if length > self.chunk_size:
+            raise ValueError("Telemetry of {} bytes is larger than the {} byte chunk size".format(length, self.chunk_size))
+        if self._telemetry is None:
+            self._telemetry = bytearray(HEADER_SIZE + self.chunk_size)
+        message = memoryview(self._telemetry)
+        message[HEADER_SIZE:HEADER_SIZE + length] = payload
+        self._transfer(message, pack_message(message, TYPE_TELEMETRY, 0, self.frame_id, 0, length))
+
+    def poll(self):
+        length = pack_message(self._control, TYPE_POLL, 0, self.frame_id, 0, 0)
+        self._transfer(self._control, length)
+        return self.ready
+
+    # Polls until the ESP32 can take a new frame
+    def wait_ready(self):
+        self.ready = False
+        while not self.poll():
+            pass
+
+    def _transfer(self, message, length):
+        rx = self._rx_mv[:length]
+        self.cs.off()
+        self.spi_bus.write_readinto(memoryview(message)[:length], rx)
+        self.cs.on()
+        self._handle_status(rx)
+
+    def _handle_status(self, rx):
+        status = unpack_message(rx, HEADER_SIZE)
+        if status is None or status[0] != TYPE_STATUS:
+            self.ready = False
+            return
+
+        msg_type, flags, frame_id, received_in_order, payload_length, nack = status
+        if flags & FLAG_CHUNK_LIMIT:
+            self.peer_max_chunk = nack
+            self.ready = False
+            return
+        self.status_frame_id = frame_id
+        self.ready = bool(flags & FLAG_READY)
+        if frame_id != self.frame_id:
+            return
+        self.frame_ok = bool(flags & FLAG_FRAME_OK)
+        if received_in_order > self.acked:
+            self.acked = received_in_order
+        if nack == NO_CHUNK or nack >= self.chunk_index:
+            return
+        if nack < self.chunk_index - self.window:
+            raise LinkError("Chunk {} of frame {} is no longer in the resend window".format(nack, frame_id))
+
+        self._resend(nack)
+
+    def _resend(self, chunk_index):
+        slot = chunk_index % self.window
+        self.retransmissions += 1
+        self._transfer(self._messages[slot], self._message_lengths[slot])
+
+
+'''
+Reference receiver for the ESP32 side, also runs on host CPython
+* exchange() takes the bytes clocked in during one transaction and returns the bytes to clock out
+* Completed images are appended to frames and their stream (from END) to frame_streams, the last telemetry
+  payload is kept in telemetry
+* max_chunk_size is the largest chunk the ESP32 can take (its DMA buffer), None for any size
+'''
+class LinkReceiver:
+    def __init__(self, max_frames=None, max_chunk_size=None):
+        self.frames = []
+        self.frame_streams = []
+        self.max_frames = max_frames
+        self.max_chunk_size = max_chunk_size
+        self.chunk_size = None
+        self.telemetry = None
+        self._chunk_limit_pending = False
+        self._status = bytearray(HEADER_SIZE)
+
+        self.frame_id = None
+        self.chunks = {}
+        self.received_in_order = 0
+        self.received_end = 0
+        self.chunk_count = None
+        self.payload_length = 0
+        self.stream = 0
+        self.frame_ok = False
+        self.nacks = []
+        self._nacked_at = {}
+        self._exchanges = 0
+
+        # Counters
+        self.corrupt_messages = 0
+        self.nacks_sent = 0
+
+    def exchange(self, tx):
+        self._exchanges += 1
+        nack = NO_CHUNK
+        flags = 0
+        if self._chunk_limit_pending:
+            self._chunk_limit_pending = False
+            flags |= FLAG_CHUNK_LIMIT
+            nack = self.max_chunk_size
+        elif self.nacks:
+            nack = self.nacks.pop(0)
+            self.nacks_sent += 1
+        if self.frame_id is None or self.frame_ok:
+            flags |= FLAG_READY
+        if self.frame_ok:
+            flags |= FLAG_FRAME_OK
+        frame_id = self.frame_id if self.frame_id is not None else 0
+        pack_message(self._status, TYPE_STATUS, flags, frame_id, self.received_in_order, 0, nack)
+        reply = bytes(self._status) + bytes(max(0, len(tx) - HEADER_SIZE))
+
+        self._handle(tx)
+        return reply
+
+    def _handle(self, tx):
+        message = unpack_message(tx)
+        if message is None:
+            # Nothing in a corrupt header can be trusted, missing chunks are NACKed from the gap they leave
+            self.corrupt_messages += 1
+            return
+
+        msg_type, flags, frame_id, chunk_index, payload_length, arg = message
+        payload = memoryview(tx)[HEADER_SIZE:HEADER_SIZE + payload_length]
+        if msg_type == TYPE_TELEMETRY:
+            self.telemetry = bytes(payload)
+            return
+        if msg_type == TYPE_START:
+            length_hint, chunk_size = struct.unpack_from(CONTROL_FORMAT, payload, 0)
+            if self.max_chunk_size is not None and chunk_size > self.max_chunk_size:
+                self._chunk_limit_pending = True
+                return
+            self.chunk_size = chunk_size
+        if frame_id != self.frame_id:
+            # A lost START is implied by any message of the next frame
+            if msg_type == TYPE_POLL or not (self.frame_id is None or self.frame_ok):
+                return
+            self._start_frame(frame_id)
+        if self.frame_ok:
+            return
+        if msg_type == TYPE_CHUNK:
+            self._add_chunk(chunk_index, payload)
+        elif msg_type == TYPE_END:
+            self.payload_length, self.chunk_count = struct.unpack_from(CONTROL_FORMAT, payload, 0)
+            self.stream = arg
+            self._nack_missing(self.chunk_count)
+            self._check_complete()
+        elif msg_type == TYPE_POLL:
+            # A resent chunk may have been lost as well
+            self._nack_missing(self.chunk_count if self.chunk_count is not None else self.received_end)
+
+    def _start_frame(self, frame_id):
+        self.frame_id = frame_id
+        self.chunks = {}
+        self.received_in_order = 0
+        self.received_end = 0
+        self.chunk_count = None
+        self.frame_ok = False
+        self.nacks = []
+        self._nacked_at = {}
+
+    def _add_chunk(self, chunk_index, payload):
+        if chunk_index in self.chunks:
+            return
+        self.chunks[chunk_index] = bytes(payload)
+        self.received_end = max(self.received_end, chunk_index + 1)
+        if chunk_index > self.received_in_order:
+            self._nack_missing(chunk_index)
+        while self.received_in_order in self.chunks:
+            self.received_in_order += 1
+        if self.chunk_count is not None:
+            self._check_complete()
+
+    def _nack_missing(self, end):
+        for index in range(self.received_in_order, end):
+            if index in self.chunks or index in self.nacks:
+                continue
+            # Give the sender time to answer the last NACK before asking again
+            if self._exchanges - self._nacked_at.get(index, -3) < 3:
+                continue
+            self._nacked_at[index] = self._exchanges
+            self.nacks.append(index)
+
+    def _check_complete(self):
+        if self.received_in_order < self.chunk_count:
+            return
+        image = b''.join([self.chunks[i] for i in range(self.chunk_count)])
+        if len(image) != self.payload_length:
+            raise LinkError("Frame {} is {} bytes, END reported {}".format(self.frame_id, len(image), self.payload_length))
+        self.frame_ok = True
+        self.chunks = {}
+        self.frames.append(image)
+        self.frame_streams.append(self.stream)
+        if self.max_frames is not None and len(self.frames) > self.max_frames:
+            self.frames.pop(0)
+            self.frame_streams.pop(0)
+
+
+'''
+Connects a LinkSender straight to a LinkReceiver, can corrupt messages to exercise retransmission
+* Pass the same object as spi_bus and cs
+* corrupt(count) is called with the running transaction count, return True to flip a bit in that message
+'''
+class LoopbackLink:
+    def __init__(self, receiver, corrupt=None):
+        self.receiver = receiver
+        self.corrupt = corrupt
+        self.transactions = 0
+
+    def on(self):
+        pass
+
+    def off(self):
+        pass
+
+    def write_readinto(self, tx, rx):
+        self.transactions += 1
+        data = bytearray(tx)
+        if self.corrupt is not None and self.corrupt(self.transactions):
+            data[len(data) // 2] ^= 0x10
+        rx[:] = self.receiver.exchange(data)[:len(rx)]
+
+
+def loopback_test(frames=20, chunk_size=256, error_rate=0.05):
+    import random
+    receiver = LinkReceiver()
+    link = LoopbackLink(receiver, lambda count: random.random() < error_rate)
+    sender = LinkSender(link, link, chunk_size=chunk_size)
+
+    retransmissions = 0
+    for i in range(frames):
+        image = bytes(random.getrandbits(8) for _ in range(random.randrange(1, 20 * chunk_size)))
+        sender.begin_frame(len(image) + 64)
+        for start in range(0, len(image), chunk_size):
+            sender.send_chunk(image[start:start + chunk_size])
+        sender.end_frame(len(image))
+        retransmissions += sender.retransmissions
+        if receiver.frames[-1] != image:
+            raise LinkError("Frame {} did not survive the loopback".format(i))
+    print('{} frames ok, {} corrupt messages, {} chunks resent'.format(frames, receiver.corrupt_messages, retransmissions))
+
+
+if __name__ == '__main__':
+    loopback_test()
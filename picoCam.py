@@ -1,33 +1,200 @@
-from utime import sleep_ms
-import utime
-import time
 import math
+import gc
+from array import array
 
-import uos
-import ujson
+# Host CPython has no MicroPython modules or board, simcam stands in for both (see simcam.py)
+try:
+    import utime
+    import uos
+    import ujson
+except ImportError:
+    from simcam import utime, uos, ujson
+try:
+    from machine import Pin, SPI, reset, lightsleep
+except ImportError:
+    from simcam import Pin, SPI, reset, lightsleep
+
+sleep_ms = utime.sleep_ms
+sleep_us = utime.sleep_us
+
+import linkproto
+# Viper compiled on the board, pure Python on the host
+from kernels import find_marker, block_luma_sums
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+# The link worker runs on the second core of the RP2040, host CPython uses a plain thread
+try:
+    import threading
+
+    def _start_worker(target):
+        threading.Thread(target=target, daemon=True).start()
+    _allocate_lock = threading.Lock
+except ImportError:
+    import _thread
+
+    def _start_worker(target):
+        _thread.start_new_thread(target, ())
+    _allocate_lock = _thread.allocate_lock
+
+
+class CameraTimeoutError(Exception):
+    pass
+
+
+'''
+Timing samples (us) of one named timer, the last ring_length samples are kept in a preallocated ring
+* min and max cover every sample since the last reset, mean and p99 cover the ring. There is no running
+  total, on the RP2040 it would outgrow a small int and every record would allocate
+'''
+class TelemetryTimer:
+    def __init__(self, ring_length):
+        self.ring = array('l', [0] * ring_length)
+        self.reset()
+
+    def reset(self):
+        self.index = 0
+        self.count = 0
+        self.min = 0
+        self.max = 0
+        self.last = 0
+
+    def record(self, us):
+        self.ring[self.index] = us
+        self.index += 1
+        if self.index == len(self.ring):
+            self.index = 0
+        if self.count == 0 or us < self.min:
+            self.min = us
+        if us > self.max:
+            self.max = us
+        if self.count < Telemetry.COUNTER_WRAP:
+            self.count += 1
+        self.last = us
+
+    def percentile(self, p):
+        samples = min(self.count, len(self.ring))
+        if samples == 0:
+            return 0
+        ordered = sorted(self.ring[:samples])
+        return ordered[min(samples - 1, (p * samples + 99) // 100 - 1)]
+
+    # [count, min, mean, p99, max, last], compact enough to send over the ESP32 link
+    def stats(self):
+        samples = min(self.count, len(self.ring))
+        mean = sum(self.ring[:samples]) // samples if samples else 0
+        return [self.count, self.min, mean, self.percentile(99), self.max, self.last]
+
+
+'''
+Always-on named timers and counters, recording allocates nothing once a name exists
+* Camera and ESP32Relay record into default_telemetry unless given their own
+* Names are added up front with add_timer() so the link worker on the second core never creates one
+* snapshot() is {'timers': {name: [count, min, mean, p99, max, last]}, 'counters': {name: value}} in us
+* Counters wrap at COUNTER_WRAP (2**30, just past the largest small int on the RP2040) like ticks_ms, take differences
+  between snapshots modulo COUNTER_WRAP. Timer counts stop there
+'''
+class Telemetry:
+    RING_LENGTH = 64
+    COUNTER_WRAP = 1 << 30
+
+    def __init__(self, ring_length=RING_LENGTH):
+        self.ring_length = ring_length
+        self.timers = {}
+        self.counters = {}
+
+    def add_timer(self, *names):
+        for name in names:
+            if name not in self.timers:
+                self.timers[name] = TelemetryTimer(self.ring_length)
+
+    def add_counter(self, *names):
+        for name in names:
+            if name not in self.counters:
+                self.counters[name] = 0
+
+    def record(self, name, us):
+        timer = self.timers.get(name)
+        if timer is None:
+            self.add_timer(name)
+            timer = self.timers[name]
+        timer.record(us)
+
+    # Records the time since start (utime.ticks_us()) and returns now
+    def lap(self, name, start):
+        now = utime.ticks_us()
+        self.record(name, utime.ticks_diff(now, start))
+        return now
+
+    def count(self, name, n=1):
+        value = self.counters.get(name, 0) + n
+        if value >= self.COUNTER_WRAP:
+            value -= self.COUNTER_WRAP
+        self.counters[name] = value
+
+    def snapshot(self):
+        timers = {}
+        for name in self.timers:
+            if self.timers[name].count:
+                timers[name] = self.timers[name].stats()
+        return {'timers': timers, 'counters': dict(self.counters)}
+
+    def reset(self):
+        for name in self.timers:
+            self.timers[name].reset()
+        for name in self.counters:
+            self.counters[name] = 0
+
+    def report(self):
+        for name in sorted(self.timers):
+            timer = self.timers[name]
+            if timer.count:
+                count, minimum, mean, p99, maximum, last = timer.stats()
+                print(f"{name}: n={count} min={minimum} mean={mean} p99={p99} max={maximum} us")
+        for name in sorted(self.counters):
+            print(f"{name}: {self.counters[name]}")
+
+default_telemetry = Telemetry()
 
-from machine import Pin, SPI, reset
 
 '''
 Start this alongside the camera module to save photos in a folder with a filename i.e. image-<counter>.jpg
 * appends '_' after a word, the next number and the file format
+* Counters are kept in file_manager_name (a JSON dict) plus a journal next to it, each new filename appends one
+  [name, count] line to the journal. Startup replays the journal over the dict, a line torn by a crash is ignored
+* Every COMPACT_EVERY appends the dict is written to a temporary file, renamed over file_manager_name and the
+  journal is emptied. Replaying a journal that survived a crash sets the same counts again
 '''
 class FileManager:
+    COMPACT_EVERY = 64
+    JOURNAL_SUFFIX = '.journal'
+    TEMP_SUFFIX = '.tmp'
+
     def __init__(self, file_manager_name='filemanager.log'):
         
         self.FILE_MANAGER_LOG_NAME = file_manager_name
+        self.journal_name = file_manager_name + self.JOURNAL_SUFFIX
         self.last_request_filename = None
         self.suffix = None
-        count = 0
+        self.journal_entries = 0
         file_dict = {}
+        files = uos.listdir()
         # Ensure file is present
-        if self.FILE_MANAGER_LOG_NAME not in uos.listdir():
+        if self.FILE_MANAGER_LOG_NAME not in files:
             with open(self.FILE_MANAGER_LOG_NAME, 'w') as f:
                 f.write(ujson.dumps(file_dict))
+        # Left over from a compaction that did not finish, the dict and journal are still complete
+        if self.FILE_MANAGER_LOG_NAME + self.TEMP_SUFFIX in files:
+            uos.remove(self.FILE_MANAGER_LOG_NAME + self.TEMP_SUFFIX)
             
         # Check if the filename already exists in the storage
         with open(self.FILE_MANAGER_LOG_NAME, 'r') as f:
             self.file_dict = ujson.loads(f.read())
+        if self.journal_name in files:
+            self._replay_journal()
 
 
     def new_jpg_fn(self, requested_filename=None):
@@ -47,17 +214,138 @@ class FileManager:
             count = self.file_dict[requested_filename] + 1
         self.file_dict[requested_filename] = count
         
-        self.save_manager_file()
+        self._append_journal(requested_filename, count)
         new_filename = f"{requested_filename}_{count}" if count > 0 else f"{requested_filename}"
         
         return new_filename
     
+    # Compacts the journal into the dict file
     def save_manager_file(self):
         # Save the updated list back to the storage
-        with open(self.FILE_MANAGER_LOG_NAME, 'w') as f:
+        temp_name = self.FILE_MANAGER_LOG_NAME + self.TEMP_SUFFIX
+        with open(temp_name, 'w') as f:
             f.write(ujson.dumps(self.file_dict))
+        uos.rename(temp_name, self.FILE_MANAGER_LOG_NAME)
+        with open(self.journal_name, 'w') as f:
+            pass
+        self.journal_entries = 0
+
+    def _append_journal(self, name, count):
+        with open(self.journal_name, 'a') as f:
+            f.write(ujson.dumps([name, count]) + '\n')
+        self.journal_entries += 1
+        if self.journal_entries >= self.COMPACT_EVERY:
+            self.save_manager_file()
+
+    def _replay_journal(self):
+        torn = False
+        with open(self.journal_name, 'r') as f:
+            for line in f:
+                try:
+                    name, count = ujson.loads(line)
+                except ValueError:
+                    # Only the last line can be torn
+                    torn = True
+                    break
+                self.file_dict[name] = count
+                self.journal_entries += 1
+        # New lines must not be appended to a torn one
+        if torn or self.journal_entries >= self.COMPACT_EVERY:
+            self.save_manager_file()
+
 
 
+'''
+Keeps captured images in directory within a byte and/or file quota, the oldest images are removed first
+* Images are named <prefix>_<sequence>.jpg, the directory is listed once at startup to rebuild the index
+  of sequence numbers and sizes, saves only touch the index
+* Room for cam.received_length (the FIFO length, an upper bound of the JPEG) is made before each save
+* Without quotas max_bytes is QUOTA_FRACTION of the free space at startup plus the images already stored,
+  the quota has to leave room for anything else written to the filesystem
+'''
+class ImageStore:
+    QUOTA_FRACTION = 0.8
+
+    def __init__(self, directory='images', max_bytes=None, max_files=None, prefix='image'):
+        self.directory = directory
+        self.prefix = prefix
+        self.max_files = max_files
+        self.evicted_files = 0
+        self.file_sink = FileSink()
+
+        # Oldest first, (sequence, size)
+        self.index = []
+        self.total_bytes = 0
+        self.next_sequence = 0
+
+        if directory not in uos.listdir():
+            uos.mkdir(directory)
+        self._load_index()
+
+        if max_bytes is None and max_files is None:
+            stat = uos.statvfs(directory)
+            max_bytes = int(stat[0] * stat[3] * self.QUOTA_FRACTION) + self.total_bytes
+        self.max_bytes = max_bytes
+
+    def path(self, sequence):
+        return f"{self.directory}/{self.prefix}_{sequence}.jpg"
+
+    # Streams the captured frame to the next file, returns its path
+    def save(self, cam):
+        self.make_room(cam.received_length)
+        sequence = self.next_sequence
+        self.next_sequence += 1
+        path = self.path(sequence)
+        self.file_sink.filename = path
+        size = cam.stream_fifo(self.file_sink)
+        self.index.append((sequence, size))
+        self.total_bytes += size
+        return path
+
+    # Evicts the oldest images until another image of size bytes fits both quotas
+    def make_room(self, size=0):
+        while self.index:
+            over_files = self.max_files is not None and len(self.index) + 1 > self.max_files
+            over_bytes = self.max_bytes is not None and self.total_bytes + size > self.max_bytes
+            if not (over_files or over_bytes):
+                break
+            self.evict_oldest()
+
+    def evict_oldest(self):
+        sequence, size = self.index.pop(0)
+        try:
+            uos.remove(self.path(sequence))
+        except OSError:
+            # Already removed by hand
+            pass
+        self.total_bytes -= size
+        self.evicted_files += 1
+
+    def newest(self):
+        if not self.index:
+            return None
+        return self.path(self.index[-1][0])
+
+    def _load_index(self):
+        start = self.prefix + '_'
+        for name in uos.listdir(self.directory):
+            if name.endswith(FileSink.TEMP_SUFFIX):
+                # Cut short by a power loss
+                uos.remove(f"{self.directory}/{name}")
+                continue
+            if not (name.startswith(start) and name.endswith('.jpg')):
+                continue
+            try:
+                sequence = int(name[len(start):-4])
+            except ValueError:
+                continue
+            size = uos.stat(f"{self.directory}/{name}")[6]
+            self.index.append((sequence, size))
+            self.total_bytes += size
+        self.index.sort()
+        if self.index:
+            self.next_sequence = self.index[-1][0] + 1
+
 
 class Camera:
     # Required imports
@@ -216,9 +504,9 @@ class Camera:
         '1600x1200': RESOLUTION_1600X1200,
         '1920x1080': RESOLUTION_1920X1080,
         '2048x1536': RESOLUTION_2048X1536,
-        '96X96': RESOLUTION_96X96,
-        '128X128': RESOLUTION_128X128,
-        '320X320': RESOLUTION_320X320
+        '96x96': RESOLUTION_96X96,
+        '128x128': RESOLUTION_128X128,
+        '320x320': RESOLUTION_320X320
     }
 
     valid_5mp_resolutions = {
@@ -228,9 +516,21 @@ class Camera:
         '1600x1200': RESOLUTION_1600X1200,
         '1920x1080': RESOLUTION_1920X1080,
         '2592x1944': RESOLUTION_2592X1944,
-        '96X96': RESOLUTION_96X96,
-        '128X128': RESOLUTION_128X128,
-        '320X320': RESOLUTION_320X320
+        '96x96': RESOLUTION_96X96,
+        '128x128': RESOLUTION_128X128,
+        '320x320': RESOLUTION_320X320
+    }
+
+    # Raw frames are only read back at these resolutions, larger ones do not fit in the RP2040's RAM
+    RAW_RESOLUTION_SIZES = {
+        RESOLUTION_96X96: (96, 96),
+        RESOLUTION_128X128: (128, 128),
+        RESOLUTION_320X240: (320, 240)
+    }
+    # YUV is 4:2:2, two bytes per pixel like RGB565
+    RAW_BYTES_PER_PIXEL = {
+        CAM_IMAGE_PIX_FMT_RGB565: 2,
+        CAM_IMAGE_PIX_FMT_YUV: 2
     }
 
     # FIFO and State setting registers
@@ -248,11 +548,52 @@ class Camera:
     SINGLE_FIFO_READ = 0x3D
     BURST_FIFO_READ = 0X3C
     
-    # Size of image_buffer (Burst reading)
+    # Default size of image_buffer (Burst reading), see burst_length
     BUFFER_MAX_LENGTH = 1024
+
+    # Delay after each register write, the Arducam Library uses 1ms. See calibrate_write_pacing()
+    WRITE_PACING_US = 1000
+    # Longest run of registers read in one transaction
+    MAX_BLOCK_READ_LENGTH = 8
+
+    # Waits raise CameraTimeoutError after these
+    CAPTURE_TIMEOUT_MS = 3000
+    IDLE_TIMEOUT_MS = 1000
+
+    # Polling sleeps for half of the time left to the expected finish, then every POLL_TIGHT_US once
+    # within POLL_TIGHT_WINDOW_US of it. Overdue waits back off towards POLL_MAX_US
+    POLL_TIGHT_US = 100
+    POLL_TIGHT_WINDOW_US = 2000
+    POLL_MAX_US = 2000
+
+    # Starting estimates, each capture refines the estimate for its resolution
+    CAPTURE_TIME_ESTIMATE_MS = {
+        RESOLUTION_96X96: 30,
+        RESOLUTION_128X128: 30,
+        RESOLUTION_320X240: 40,
+        RESOLUTION_320X320: 40,
+        RESOLUTION_640X480: 60,
+        RESOLUTION_1280X720: 100,
+        RESOLUTION_1600X1200: 150,
+        RESOLUTION_1920X1080: 150,
+        RESOLUTION_2048X1536: 200,
+        RESOLUTION_2592X1944: 300
+    }
     
     # For 5MP startup routine
     WHITE_BALANCE_WAIT_TIME_MS = 500
+    # Frames captured and discarded by warm_up() so exposure and AWB can settle
+    WARM_UP_FRAMES = 1
+
+    # Control register values after CAM_REG_SENSOR_RESET, seeds the register shadow
+    RESET_REGISTER_DEFAULTS = {
+        CAM_REG_COLOR_EFFECT_CONTROL: SPECIAL_NORMAL,
+        CAM_REG_BRIGHTNESS_CONTROL: BRIGHTNESS_DEFAULT,
+        CAM_REG_CONTRAST_CONTROL: CONTRAST_DEFAULT,
+        CAM_REG_SATURATION_CONTROL: SATURATION_DEFAULT,
+        CAM_REG_EXPOSURE_CONTROL: EXPOSURE_DEFAULT,
+        CAM_REG_WB_MODE_CONTROL: WB_MODE_AUTO
+    }
 
 
 # User callable functions
@@ -265,26 +606,60 @@ class Camera:
 ##################### Callable FUNCTIONS #####################
 
 ########### CORE PHOTO FUNCTIONS ###########
-    def __init__(self, spi_bus, cs, skip_sleep=False, debug_information=False):
+    def __init__(self, spi_bus, cs, skip_sleep=False, debug_information=False, write_pacing_us=WRITE_PACING_US,
+                 burst_length=BUFFER_MAX_LENGTH, telemetry=None, bus_lock=None, fast_start=False, profile_file=None):
         self.cs = cs
         self.spi_bus = spi_bus
+        # Shared with the other devices on spi_bus when they are driven from another thread, see MultiCamera
+        self.bus_lock = bus_lock
+
+        self.telemetry = telemetry if telemetry is not None else default_telemetry
+        self.telemetry.add_timer('capture', 'capture_wait', 'idle_wait', 'cam_read')
+        self.telemetry.add_counter('frames', 'fifo_bytes', 'timeouts')
+        self._trigger_start = 0
+
+        # Register transactions reuse these buffers
+        self.write_pacing_us = write_pacing_us
+        self._reg_write_buffer = bytearray(2)
+        self._reg_command = bytearray(1)
+        self._reg_read_buffer = bytearray(1 + self.MAX_BLOCK_READ_LENGTH)
+        self._reg_read_mv = memoryview(self._reg_read_buffer)
+        # None until a capture shows whether FIFO_SIZE1..3 can be read in one transaction
+        self.multi_register_read = None
+
+        # Measured wait times (us)
+        self.capture_time_estimates_us = {}
+        for resolution in self.CAPTURE_TIME_ESTIMATE_MS:
+            self.capture_time_estimates_us[resolution] = self.CAPTURE_TIME_ESTIMATE_MS[resolution] * 1000
+        self.expected_idle_us = 0
+        self.last_capture_wait_us = 0
+        self.last_idle_wait_us = 0
+
+        # Last value written to each sensor register, unchanged writes are skipped
+        self.register_shadow = {}
+        self._pending_registers = None
+
+        self.camera_idx = 'NOT DETECTED'
+        self.fast_start = fast_start
+        profile = self._load_profile(profile_file)
 
         self._write_reg(self.CAM_REG_SENSOR_RESET, self.CAM_SENSOR_RESET_ENABLE) # Reset camera
         self._wait_idle()
-        self._get_sensor_config() # Get camera sensor information
-        self._wait_idle()
-        self._write_reg(self.CAM_REG_DEBUG_DEVICE_ADDRESS, self.deviceAddress)
-        self._wait_idle()
-
-        self.run_start_up_config = True
+        self.register_shadow = dict(self.RESET_REGISTER_DEFAULTS)
+        if profile is not None:
+            self._apply_profile(profile)
+        else:
+            self._get_sensor_config() # Get camera sensor information
+            self._wait_idle()
+        self._set_reg(self.CAM_REG_DEBUG_DEVICE_ADDRESS, self.deviceAddress)
 
-        # Set default format and resolution
+        # Set default format and resolution, both are written by the first capture
         self.current_pixel_format = self.CAM_IMAGE_PIX_FMT_JPG
-        self.old_pixel_format = self.current_pixel_format
-        
+        # None leaves the sensor default, see set_image_quality()
+        self.current_image_quality = None
+        # Registers written by the last prepare_capture()
+        self.settings_written = 0
         self.current_resolution_setting = self.RESOLUTION_640X480 # ArduCam driver defines this as mode
-        self.old_resolution = self.current_resolution_setting
-        
         
         self.set_filter(self.SPECIAL_NORMAL)
         
@@ -293,20 +668,29 @@ class Camera:
         
         # Burst setup
         self.first_burst_run = False
-        self.image_buffer = bytearray(self.BUFFER_MAX_LENGTH)
+        self.first_burst_fifo = True
+        self.set_burst_length(burst_length)
         self.valid_image_buffer = 0
-        
-        self.camera_idx = 'NOT DETECTED'
-        
-        
+        self._burst_read_command = bytes([self.BURST_FIFO_READ])
+        self._burst_dummy_byte = bytearray(1)
+        self.jpeg_framer = JpegFramer()
+        self.file_sink = None
+        self.raw_frame = None
+        self.fifo_read_time = 0
+        self.fifo_read_us = 0
+
         # Tracks the AWB warmup time
         self.start_time = utime.ticks_ms()
         if debug_information:
             print('Camera version =', self.camera_idx)
         if self.camera_idx == '3MP':
-            self.startup_routine_3MP()
+            if fast_start:
+                self.warm_up()
+            else:
+                self.startup_routine_3MP()
         
-        if self.camera_idx == '5MP' and skip_sleep == False:
+        # With fast_start the first capture only waits for what is left of the settling time
+        if self.camera_idx == '5MP' and skip_sleep == False and not fast_start:
             utime.sleep_ms(self.WHITE_BALANCE_WAIT_TIME_MS)
 
 
@@ -318,208 +702,237 @@ class Camera:
         uos.remove('dummy_image.jpg')
         print('complete')
 
+    # Captures and discards frames without reading the FIFO, the next capture clears it
+    def warm_up(self, frames=WARM_UP_FRAMES):
+        for i in range(frames):
+            self.capture_jpg()
+            self.received_length = 0
+
     '''
     Issue warning if the filepath doesnt end in .jpg (Blank) and append
     Issue error if the filetype is NOT .jpg
     '''
     def capture_jpg(self):
+        if self.fast_start:
+            self.wait_white_balance()
 
-        if (utime.ticks_diff(utime.ticks_ms(), self.start_time) <= self.WHITE_BALANCE_WAIT_TIME_MS) and self.camera_idx == '5MP':
+        if self._white_balance_settling():
             print('Please add a ', self.WHITE_BALANCE_WAIT_TIME_MS, 'ms delay to allow for white balance to run')
         else:
 #             print('Starting capture JPG')
-            # JPG, bmp ect
-            # TODO: PROPERTIES TO CONFIGURE THE PIXEL FORMAT
-            if (self.old_pixel_format != self.current_pixel_format) or self.run_start_up_config:
-                self.old_pixel_format = self.current_pixel_format
-                self._write_reg(self.CAM_REG_FORMAT, self.current_pixel_format) # Set to capture a jpg
-                self._wait_idle()
-#             print('old',self.old_resolution,'new',self.current_resolution_setting)
-                # TODO: PROPERTIES TO CONFIGURE THE RESOLUTION
-            if (self.old_resolution != self.current_resolution_setting) or self.run_start_up_config:
-                self.old_resolution = self.current_resolution_setting
-                self._write_reg(self.CAM_REG_CAPTURE_RESOLUTION, self.current_resolution_setting)
-#                 print('setting res', self.current_resolution_setting)
-                self._wait_idle()
-            self.run_start_up_config = False
-            
-            # Start capturing the photo
-            self._set_capture()
+            self.trigger_capture()
+            self.wait_capture()
 #             print('capture jpg complete')
-        
-
-    # TODO: After reading the camera data clear the FIFO and reset the camera (so that the first time read can be used)
-    def saveJPG(self,filename):
-        headflag = 0
-        print('Saving image, please dont remove power')
-#         print('rec len:', self.received_length)
-        
-        image_data = 0x00
-        image_data_next = 0x00
-        
-        image_data_int = 0x00
-        image_data_next_int = 0x00
-        
-        print(self.received_length)
-        
-        while(self.received_length):
-            
-            image_data = image_data_next
-            image_data_int = image_data_next_int
-            
-            image_data_next = self._read_byte()
-            image_data_next_int = int.from_bytes(image_data_next, 1) # TODO: CHANGE TO READ n BYTES
-            if headflag == 1:
-                jpg_to_write.write(image_data_next)
-            
-            if (image_data_int == 0xff) and (image_data_next_int == 0xd8):
-                # TODO: Save file to filename
-#                 print('start of file')
-                headflag = 1
-                jpg_to_write = open(filename,'ab')
-                jpg_to_write.write(image_data)
-                jpg_to_write.write(image_data_next)
-                
-            if (image_data_int == 0xff) and (image_data_next_int == 0xd9):
-#                 print('TODO: Save and close file?')
-                headflag = 0
-                jpg_to_write.write(image_data_next)
-                jpg_to_write.close()
-                
-    def getImageData(self, esp32CS, esp32SPI):
-        headflag = 0
-        print('Saving image, please dont remove power')
-#         print('rec len:', self.received_length)
-        
-        image_data = 0x00
-        image_data_next = 0x00
-        
-        image_data_int = 0x00
-        image_data_next_int = 0x00
-        
-        print(self.received_length)
-        
-        data = []
-        i = 0
-        
-        while(self.received_length):
-            print(i)
-            i+=1
-            image_data = image_data_next
-            image_data_int = image_data_next_int
-            
-            image_data_next = self._read_byte()
-            print(f'data next {image_data_next}')
-            image_data_next_int = int.from_bytes(image_data_next, 1) # TODO: CHANGE TO READ n BYTES
-            if headflag == 1:
-                data = image_data_next
-                print("write 1")
-                esp32CS.low()
-                esp32SPI.write(image_data_next)
-                esp32CS.high()
-            
-            if (image_data_int == 0xff) and (image_data_next_int == 0xd8):
-                headflag = 1
-                print("write 2")
-                esp32CS.low()
-                esp32SPI.write(image_data)
-                esp32SPI.write(image_data_next)
-                esp32CS.high()
-                
-            if (image_data_int == 0xff) and (image_data_next_int == 0xd9):
-                headflag = 0
-                print("write 3")
-                esp32CS.low()
-                esp32SPI.write(image_data_next)
-                esp32CS.high()
-            time.sleep(.01)
-        return data
 
+    # capture_jpg in two halves, the sensor exposes between trigger_capture() and wait_capture()
+    def trigger_capture(self):
+        self.prepare_capture()
+        self.start_capture()
 
+    # Everything before the trigger, start_capture() is then a single register write
+    def prepare_capture(self):
+        # JPG, bmp ect, only written when changed along with any pending settings
+        self._stage_capture_settings()
+        self.settings_written = self.apply()
 
+        self._clear_fifo_flag()
+        self._wait_idle()
 
+    # Without pace the caller waits write_pacing_us before the next register write, see MultiCamera
+    def start_capture(self, pace=True):
+        self._trigger_start = utime.ticks_us()
+        self._start_capture(pace)
 
-    def save_JPG_burst(self):
-        headflag = 0
-        print('Saving image, please dont remove power')
+    def wait_capture(self):
+        self._wait_capture_done()
+        self.telemetry.lap('capture', self._trigger_start)
+        self._read_capture_length()
 
-        image_data = 0x00
-        image_data_next = 0x00
+    # Same as capture_jpg but yields to other uasyncio tasks while the sensor is busy
+    async def capture_jpg_async(self):
+        if self.fast_start:
+            await asyncio.sleep(self.white_balance_remaining_ms() / 1000)
 
-        image_data_int = 0x00
-        image_data_next_int = 0x00
+        if self._white_balance_settling():
+            print('Please add a ', self.WHITE_BALANCE_WAIT_TIME_MS, 'ms delay to allow for white balance to run')
+            return
 
-        print(self.received_length)
+        self._stage_capture_settings()
+        await self.apply_async()
 
-        while(self.received_length):
-            self._burst_read_FIFO()
-            
-            start_bytes = self.image_buffer[0]
-            end_bytes = self.image_buffer[self.valid_image_buffer-1]
-            
+        self._clear_fifo_flag()
+        await self._wait_idle_async()
+        self.start_capture()
+        await self._wait_capture_done_async()
+        self.telemetry.lap('capture', self._trigger_start)
+        self._read_capture_length()
         
-#     def _read_byte(self):
-#         self.cs.off()
-#         self.spi_bus.write(bytes([self.SINGLE_FIFO_READ]))
-#         data = self.spi_bus.read(1)
-#         data = self.spi_bus.read(1)
-#         self.cs.on()
-#         self.received_length -= 1
-#         return data
-
-
-    def _burst_read_FIFO(self):
-        #compute how many bytes to read
-        burst_read_length = self.BUFFER_MAX_LENGTH # Default to max length
-        if self.received_length < self.BUFFER_MAX_LENGTH:
+
+    # TODO: After reading the camera data clear the FIFO and reset the camera (so that the first time read can be used)
+    def saveJPG(self, filename):
+        print('Saving image, please dont remove power')
+        if self.file_sink is None:
+            self.file_sink = FileSink()
+        self.file_sink.filename = filename
+        return self.stream_fifo(self.file_sink)
+
+    def getImageData(self, esp32CS, esp32SPI):
+        return self.stream_fifo(SPISink(esp32SPI, esp32CS))
+
+    '''
+    Capture an RGB565 or YUV frame into frame (a RawFrame), nothing is allocated per frame
+    * Needs set_pixel_format(CAM_IMAGE_PIX_FMT_RGB565 or CAM_IMAGE_PIX_FMT_YUV) and a resolution in
+      RAW_RESOLUTION_SIZES (96x96, 128x128, 320x240)
+    * Without frame the camera's raw_frame is used, allocated on first use and only reallocated to grow
+    '''
+    def capture_raw(self, frame=None):
+        if self.RAW_RESOLUTION_SIZES.get(self.current_resolution_setting) is None:
+            raise ValueError("Raw capture needs a resolution of 96x96, 128x128 or 320x240")
+        if self.current_pixel_format not in self.RAW_BYTES_PER_PIXEL:
+            raise ValueError("Raw capture needs CAM_IMAGE_PIX_FMT_RGB565 or CAM_IMAGE_PIX_FMT_YUV")
+        self.capture_jpg()
+        return self.read_raw(frame)
+
+    # Burst reads exactly width * height * bytes per pixel of the captured FIFO into frame in one transaction
+    def read_raw(self, frame=None):
+        geometry = self._raw_geometry()
+        if geometry is None:
+            raise ValueError("The last capture was not a raw frame at a resolution in RAW_RESOLUTION_SIZES")
+        width, height, stride = geometry
+        length = stride * height
+        if self.received_length < length:
+            raise ValueError("FIFO holds {} bytes, a {}x{} frame is {}".format(self.received_length, width, height, length))
+        if frame is None:
+            if self.raw_frame is None or len(self.raw_frame.buffer) < length:
+                self.raw_frame = None
+                self.raw_frame = RawFrame(length)
+            frame = self.raw_frame
+        elif len(frame.buffer) < length:
+            raise ValueError("Raw frame needs {} bytes, the buffer has {}".format(length, len(frame.buffer)))
+
+        start_read = utime.ticks_us()
+        self.first_burst_fifo = True
+        if length == len(frame.buffer):
+            self._burst_read_into(frame.buffer)
+        else:
+            self._burst_read_into(frame.buffer_mv[:length])
+        # Anything left is padding, it is cleared with the next capture
+        self.received_length = 0
+        self.fifo_read_us = utime.ticks_diff(utime.ticks_us(), start_read)
+        self.fifo_read_time = self.fifo_read_us // 1000
+        self.telemetry.record('cam_read', self.fifo_read_us)
+        self.telemetry.count('frames')
+        self.telemetry.count('fifo_bytes', length)
+
+        frame.width = width
+        frame.height = height
+        frame.stride = stride
+        frame.length = length
+        frame.pixel_format = self.register_shadow.get(self.CAM_REG_FORMAT)
+        return frame
+
+    # (width, height, stride) of the frame in the FIFO, None unless it is raw at a known size
+    def _raw_geometry(self):
+        bytes_per_pixel = self.RAW_BYTES_PER_PIXEL.get(self.register_shadow.get(self.CAM_REG_FORMAT))
+        size = self.RAW_RESOLUTION_SIZES.get(self.register_shadow.get(self.CAM_REG_CAPTURE_RESOLUTION))
+        if bytes_per_pixel is None or size is None:
+            return None
+        return size[0], size[1], size[0] * bytes_per_pixel
+
+    '''
+    Burst read the FIFO and push each chunk to a sink (see StreamSink)
+    * jpeg_framing passes on only the bytes from SOI (FFD8) to EOI (FFD9) and stops reading at EOI
+    * on_drained() is called once the FIFO has been read, before sink.end(), e.g. to start the next capture
+    * Returns the number of bytes written to the sink
+    '''
+    def stream_fifo(self, sink, jpeg_framing=True, on_drained=None):
+        framer = self._begin_stream(sink, jpeg_framing)
+        while self.received_length:
+            self._stream_chunk(sink, framer)
+        return self._end_stream(sink, framer, on_drained)
+
+    # Same as stream_fifo but yields to other uasyncio tasks between chunks
+    async def stream_fifo_async(self, sink, jpeg_framing=True, on_drained=None):
+        framer = self._begin_stream(sink, jpeg_framing)
+        while self.received_length:
+            self._stream_chunk(sink, framer)
+            await asyncio.sleep(0)
+        return self._end_stream(sink, framer, on_drained)
+
+    def _begin_stream(self, sink, jpeg_framing):
+        framer = None
+        if self.register_shadow.get(self.CAM_REG_FORMAT) in self.RAW_BYTES_PER_PIXEL:
+            # Raw frames have no markers, only the frame itself is passed on and not the FIFO padding
+            geometry = self._raw_geometry()
+            if geometry is not None:
+                self.received_length = min(self.received_length, geometry[2] * geometry[1])
+        elif jpeg_framing:
+            framer = self.jpeg_framer
+            framer.reset()
+
+        self.first_burst_fifo = True
+        self.fifo_read_us = 0
+        self._stream_length = 0
+        sink.begin(self.received_length)
+        return framer
+
+    def _stream_chunk(self, sink, framer):
+        start_read = utime.ticks_us()
+        length = self._burst_read_FIFO_readinto()
+        read_us = utime.ticks_diff(utime.ticks_us(), start_read)
+        self.fifo_read_us += read_us
+        self.telemetry.record('cam_read', read_us)
+
+        if framer is None:
+            if length == self.burst_length:
+                sink.write(self.image_buffer)
+            else:
+                sink.write(self.image_buffer_mv[:length])
+            self._stream_length += length
+        elif framer.feed(self.image_buffer_mv, length, sink):
+            # Anything after EOI is padding, it is cleared with the next capture
+            self.received_length = 0
+
+    def _end_stream(self, sink, framer, on_drained):
+        self.fifo_read_time = self.fifo_read_us // 1000
+        payload_length = self._stream_length
+        if framer is not None:
+            payload_length = framer.payload_length
+        self.telemetry.count('frames')
+        self.telemetry.count('fifo_bytes', payload_length)
+        if on_drained is not None:
+            on_drained()
+        sink.end(payload_length)
+        return payload_length
+
+
+    def _burst_read_FIFO_readinto(self):
+        # Fills image_buffer in place and returns the number of valid bytes, nothing is allocated per chunk
+        burst_read_length = self.burst_length # Default to max length
+        if self.received_length < self.burst_length:
             burst_read_length = self.received_length
-        current_buffer_byte = 0
-        
-        self.cs.off()
-        self.spi_bus.write(bytes([self.BURST_FIFO_READ]))
-        
-        # Throw away first byte on first read
-        if self.first_burst_fifo == True:
-            data = self.spi_bus.read(1)
-            self.first_burst_fifo = False
-            
-        total_read = 0
-        while total_read < burst_read_length:
-            data = self.spi_bus.read(1) # Read from camera
-            self.image_buffer[current_buffer_byte] = data[0] # write to buffer
-            current_buffer_byte += 1
-            total_read += 1
 
-        self.cs.on()
-        self.received_length -= burst_read_length
+        if burst_read_length == self.burst_length:
+            self._burst_read_into(self.image_buffer)
+        else:
+            self._burst_read_into(self.image_buffer_mv[:burst_read_length])
+
         self.valid_image_buffer = burst_read_length
-        
-    def _burst_read_FIFO_faster(self):
-        #compute how many bytes to read
-        burst_read_length = self.BUFFER_MAX_LENGTH # Default to max length
-        if self.received_length < self.BUFFER_MAX_LENGTH:
-            burst_read_length = self.received_length
-        current_buffer_byte = 0
-        
-        self.cs.off()
-        self.spi_bus.write(bytes([self.BURST_FIFO_READ]))
-        
+        return burst_read_length
+
+    # One burst transaction filling buffer
+    def _burst_read_into(self, buffer):
+        self._select()
+        self.spi_bus.write(self._burst_read_command)
+
         # Throw away first byte on first read
-        if self.first_burst_fifo == True:
-            data = self.spi_bus.read(1)
+        if self.first_burst_fifo:
+            self.spi_bus.readinto(self._burst_dummy_byte)
             self.first_burst_fifo = False
-            
-        total_read = 0
-        self.image_buffer = self.spi_bus.read(burst_read_length)
-        
-        if self.received_length < self.BUFFER_MAX_LENGTH:
-            self.image_buffer = bytearray(self.image_buffer)
-            for i in range(self.received_length, self.BUFFER_MAX_LENGTH):
-                self.image_buffer.append(0)
 
-        self.cs.on()
-        self.received_length -= burst_read_length
-        self.valid_image_buffer = burst_read_length
+        self.spi_bus.readinto(buffer)
+        self._deselect()
+        self.received_length -= len(buffer)
 
 
     @property
@@ -541,9 +954,28 @@ class Camera:
                 raise ValueError("Invalid resolution provided for {}, please select from {}".format(self.camera_idx, list(self.valid_5mp_resolutions.keys())))
     
 
+    # Register value of a resolution name, for setting current_resolution_setting without the setter
+    def resolution_value(self, resolution):
+        valid = self.valid_5mp_resolutions if self.camera_idx == '5MP' else self.valid_3mp_resolutions
+        resolution = resolution.lower()
+        if resolution not in valid:
+            raise ValueError("Invalid resolution provided for {}, please select from {}".format(self.camera_idx, list(valid.keys())))
+        return valid[resolution]
+
     def set_pixel_format(self, new_pixel_format):
         self.current_pixel_format = new_pixel_format
 
+    # IMAGE_QUALITY_HIGH/MEDI/LOW, written with the next capture like the resolution
+    def set_image_quality(self, quality):
+        self.current_image_quality = quality
+
+    # Bytes read per burst transaction, reallocates image_buffer so only call it between frames
+    def set_burst_length(self, burst_length):
+        self.burst_length = burst_length
+        self.image_buffer = None
+        self.image_buffer = bytearray(burst_length)
+        self.image_buffer_mv = memoryview(self.image_buffer)
+
 ########### ACCSESSORY FUNCTIONS ###########
 
     # TODO: Complete for other camera settings
@@ -563,13 +995,35 @@ class Camera:
 #     BRIGHTNESS_PLUS_4 = 7
 
 
+    '''
+    Settings changed between begin_settings() and apply() are written back to back without the per write
+    pacing, apply() then waits once for the sensor to go idle
+    cam.begin_settings()
+    cam.set_brightness_level(cam.BRIGHTNESS_PLUS_1)
+    cam.set_contrast(cam.CONTRAST_MINUS_1)
+    cam.apply()
+    '''
+    def begin_settings(self):
+        if self._pending_registers is None:
+            self._pending_registers = []
+
+    def apply(self):
+        written = self._write_pending_registers()
+        if written:
+            self._wait_idle()
+        return written
+
+    async def apply_async(self):
+        written = self._write_pending_registers()
+        if written:
+            await self._wait_idle_async()
+        return written
+
     def set_brightness_level(self, brightness):
-        self._write_reg(self.CAM_REG_BRIGHTNESS_CONTROL, brightness)
-        self._wait_idle()
+        self._set_reg(self.CAM_REG_BRIGHTNESS_CONTROL, brightness)
 
     def set_filter(self, effect):
-        self._write_reg(self.CAM_REG_COLOR_EFFECT_CONTROL, effect)
-        self._wait_idle()
+        self._set_reg(self.CAM_REG_COLOR_EFFECT_CONTROL, effect)
 
 #     # Set Saturation
 #     CAM_REG_SATURATION_CONTROL = 0X24
@@ -583,8 +1037,7 @@ class Camera:
 #     SATURATION_PLUS_3 = 5
 
     def set_saturation_control(self, saturation_value):
-        self._write_reg(self.CAM_REG_SATURATION_CONTROL, saturation_value)
-        self._wait_idle()
+        self._set_reg(self.CAM_REG_SATURATION_CONTROL, saturation_value)
 
 #     # Set Exposure Value
 #     CAM_REG_EXPOSURE_CONTROL = 0X25
@@ -610,8 +1063,7 @@ class Camera:
 #     CONTRAST_PLUS_3 = 5
 
     def set_contrast(self, contrast):
-        self._write_reg(self.CAM_REG_CONTRAST_CONTROL, contrast)
-        self._wait_idle()
+        self._set_reg(self.CAM_REG_CONTRAST_CONTROL, contrast)
 
 
     def set_white_balance(self, environment):
@@ -629,8 +1081,7 @@ class Camera:
             print('TODO UPDATE: For best results set a White Balance setting')
 
         self.white_balance_mode = register_value
-        self._write_reg(self.CAM_REG_WB_MODE_CONTROL, register_value)
-        self._wait_idle()
+        self._set_reg(self.CAM_REG_WB_MODE_CONTROL, register_value)
 
 ##################### INTERNAL FUNCTIONS - HIGH LEVEL #####################
 
@@ -638,162 +1089,1549 @@ class Camera:
     def _clear_fifo_flag(self):
         self._write_reg(self.ARDUCHIP_FIFO, self.FIFO_CLEAR_ID_MASK)
 
-    def _start_capture(self):
-        self._write_reg(self.ARDUCHIP_FIFO, self.FIFO_START_MASK)
+    def _start_capture(self, pace=True):
+        self._bus_write(self.ARDUCHIP_FIFO | 0x80, self.FIFO_START_MASK, pace)
 
-    def _set_capture(self):
-#         print('a1')
-        self._clear_fifo_flag()
-        self._wait_idle()
-        self._start_capture()
-#         print('a2')
-        while (int(self._get_bit(self.ARDUCHIP_TRIG, self.CAP_DONE_MASK)) == 0):
-#             print(self._get_bit(self.ARDUCHIP_TRIG, self.CAP_DONE_MASK))
-            sleep_ms(1)
-#         print('a3')
+    def _read_capture_length(self):
         self.received_length = self._read_fifo_length()
         self.total_length = self.received_length
         self.burst_first_flag = False
+
+    def _white_balance_settling(self):
+        return (utime.ticks_diff(utime.ticks_ms(), self.start_time) < self.WHITE_BALANCE_WAIT_TIME_MS) and self.camera_idx == '5MP'
+
+    def _stage_capture_settings(self):
+        self.begin_settings()
+        self._set_reg(self.CAM_REG_FORMAT, self.current_pixel_format)
+        self._set_reg(self.CAM_REG_CAPTURE_RESOLUTION, self.current_resolution_setting)
+        if self.current_image_quality is not None:
+            self._set_reg(self.CAM_REG_IMAGE_QUALITY, self.current_image_quality)
+
+    def _write_pending_registers(self):
+        pending = self._pending_registers
+        self._pending_registers = None
+        if not pending:
+            return 0
+
+        changed = []
+        for addr, value in pending:
+            if self.register_shadow.get(addr) != value:
+                changed.append((addr, value))
+        if changed:
+            self._write_regs(changed)
+        return len(changed)
 #         print('a4')
     
-    def _read_fifo_length(self): # TODO: CONFIRM AND SWAP TO A 3 BYTE READ
-        len1 = int.from_bytes(self._read_reg(self.FIFO_SIZE1),1)
-        len2 = int.from_bytes(self._read_reg(self.FIFO_SIZE2),1)
-        len3 = int.from_bytes(self._read_reg(self.FIFO_SIZE3),1)
-        return ((len3 << 16) | (len2 << 8) | len1) & 0xffffff
+    def _read_fifo_length(self):
+        if self.multi_register_read:
+            data = self._read_regs(self.FIFO_SIZE1, 3)
+            return ((data[2] << 16) | (data[1] << 8) | data[0]) & 0xffffff
+
+        len1 = self._read_reg_value(self.FIFO_SIZE1)
+        len2 = self._read_reg_value(self.FIFO_SIZE2)
+        len3 = self._read_reg_value(self.FIFO_SIZE3)
+        length = ((len3 << 16) | (len2 << 8) | len1) & 0xffffff
+
+        # Confirm once that a 3 byte read returns the same length before switching to it
+        if self.multi_register_read is None and length:
+            data = self._read_regs(self.FIFO_SIZE1, 3)
+            self.multi_register_read = (data[0] == len1) and (data[1] == len2) and (data[2] == len3)
+        return length
+
+    # Time left (ms) before the 5MP AWB has settled, anything done after __init__ counts towards it
+    def white_balance_remaining_ms(self):
+        if self.camera_idx != '5MP':
+            return 0
+        return max(0, self.WHITE_BALANCE_WAIT_TIME_MS - utime.ticks_diff(utime.ticks_ms(), self.start_time))
+
+    def wait_white_balance(self):
+        remaining = self.white_balance_remaining_ms()
+        if remaining:
+            sleep_ms(remaining)
+
+    '''
+    Saves the sensor identity, the measured timings and the register shadow so the next boot can skip them
+    * Camera(..., profile_file=filename) then skips the sensor ID probe and writes the saved settings in one batch
+    * Delete the file after swapping the camera module
+    '''
+    def save_profile(self, filename):
+        estimates = {}
+        for resolution in self.capture_time_estimates_us:
+            estimates[str(resolution)] = self.capture_time_estimates_us[resolution]
+        registers = {}
+        for addr in self.register_shadow:
+            registers[str(addr)] = self.register_shadow[addr]
+        profile = {
+            'camera_idx': self.camera_idx,
+            'write_pacing_us': self.write_pacing_us,
+            'multi_register_read': self.multi_register_read,
+            'expected_idle_us': self.expected_idle_us,
+            'capture_time_estimates_us': estimates,
+            'registers': registers
+        }
+        temp_name = filename + FileSink.TEMP_SUFFIX
+        with open(temp_name, 'w') as f:
+            f.write(ujson.dumps(profile))
+        uos.rename(temp_name, filename)
+
+    # None when there is no usable profile, the sensor is then probed as usual
+    def _load_profile(self, filename):
+        if filename is None:
+            return None
+        try:
+            with open(filename, 'r') as f:
+                profile = ujson.loads(f.read())
+        except (OSError, ValueError):
+            return None
+        if profile.get('camera_idx') not in ('3MP', '5MP'):
+            return None
+        return profile
+
+    def _apply_profile(self, profile):
+        self.camera_idx = profile['camera_idx']
+        self.write_pacing_us = profile['write_pacing_us']
+        self.multi_register_read = profile['multi_register_read']
+        self.expected_idle_us = profile['expected_idle_us']
+        estimates = profile['capture_time_estimates_us']
+        for resolution in estimates:
+            self.capture_time_estimates_us[int(resolution)] = estimates[resolution]
+
+        registers = profile['registers']
+        self.begin_settings()
+        for addr in registers:
+            self._set_reg(int(addr), registers[addr])
+        self.apply()
 
     def _get_sensor_config(self):
-        camera_id = self._read_reg(self.CAM_REG_SENSOR_ID);
+        camera_id = self._read_reg_value(self.CAM_REG_SENSOR_ID)
         self._wait_idle()
-        if (int.from_bytes(camera_id, 1) == self.SENSOR_3MP_1) or (int.from_bytes(camera_id, 1) == self.SENSOR_3MP_2):
+        if (camera_id == self.SENSOR_3MP_1) or (camera_id == self.SENSOR_3MP_2):
             self.camera_idx = '3MP'
-        if (int.from_bytes(camera_id, 1) == self.SENSOR_5MP_1) or (int.from_bytes(camera_id, 1) == self.SENSOR_5MP_2):
+        if (camera_id == self.SENSOR_5MP_1) or (camera_id == self.SENSOR_5MP_2):
             self.camera_idx = '5MP'
 
+    '''
+    Measure how long the sensor stays busy after a register write and pace writes by the slowest sample
+    Returns the new write_pacing_us, run it once per module before save_profile() so later boots reuse it
+    '''
+    def calibrate_write_pacing(self, samples=5, margin_us=50):
+        slowest = 0
+        for i in range(samples):
+            # Rewrites the device address set in __init__, the value does not change
+            self._reg_write_buffer[0] = self.CAM_REG_DEBUG_DEVICE_ADDRESS | 0x80
+            self._reg_write_buffer[1] = self.deviceAddress
+            self._select()
+            self.spi_bus.write(self._reg_write_buffer)
+            self._deselect()
+            slowest = max(slowest, self._wait_until(self._sensor_idle, 0, self.IDLE_TIMEOUT_MS, 'Sensor idle'))
+        self.write_pacing_us = slowest + margin_us
+        return self.write_pacing_us
+
 
 ##################### INTERNAL FUNCTIONS - LOW LEVEL #####################
 
     def _read_buffer(self):
         print('COMPLETE')
 
-    def _bus_write(self, addr, val):
-        self.cs.off()
-        self.spi_bus.write(bytes([addr]))
-        self.spi_bus.write(bytes([val])) # FixMe only works with single bytes
-        self.cs.on()
-        sleep_ms(1) # From the Arducam Library
+    def _bus_write(self, addr, val, pace=True):
+        self._reg_write_buffer[0] = addr
+        self._reg_write_buffer[1] = val
+        self._select()
+        self.spi_bus.write(self._reg_write_buffer)
+        self._deselect()
+        if pace and self.write_pacing_us:
+            sleep_us(self.write_pacing_us)
         return 1
     
-    def _bus_read(self, addr):
+    # Reads count registers starting at addr in one transaction, the first byte clocked out is a dummy
+    def _bus_read(self, addr, count=1):
+        self._reg_command[0] = addr
+        self._select()
+        self.spi_bus.write(self._reg_command)
+        self.spi_bus.readinto(self._reg_read_mv[:count + 1])
+        self._deselect()
+        return self._reg_read_mv[1:count + 1]
+
+    # Every transaction is one CS frame between _select() and _deselect()
+    def _select(self):
+        if self.bus_lock is not None:
+            self.bus_lock.acquire()
         self.cs.off()
-        self.spi_bus.write(bytes([addr]))
-        data = self.spi_bus.read(1) # Only read second set of data
-        data = self.spi_bus.read(1)
+
+    def _deselect(self):
         self.cs.on()
-        return data
+        if self.bus_lock is not None:
+            self.bus_lock.release()
 
     def _write_reg(self, addr, val):
         self._bus_write(addr | 0x80, val)
 
+    # Each register is its own CS frame written back to back, the caller waits for idle once after the batch
+    def _write_regs(self, pairs):
+        for addr, val in pairs:
+            self._bus_write(addr | 0x80, val, False)
+            self.register_shadow[addr] = val
+
+    # Sensor settings go through the shadow, FIFO and trigger commands use _write_reg directly
+    def _set_reg(self, addr, val):
+        if self._pending_registers is not None:
+            for i in range(len(self._pending_registers)):
+                if self._pending_registers[i][0] == addr:
+                    self._pending_registers[i] = (addr, val)
+                    return
+            self._pending_registers.append((addr, val))
+        elif self.register_shadow.get(addr) != val:
+            self._write_reg(addr, val)
+            self.register_shadow[addr] = val
+            self._wait_idle()
+
     def _read_reg(self, addr):
-        data = self._bus_read(addr & 0x7F)
-        return data # TODO: Check that this should return raw bytes or int (int.from_bytes(data, 1))
+        return bytes(self._bus_read(addr & 0x7F))
+
+    def _read_reg_value(self, addr):
+        return self._bus_read(addr & 0x7F)[0]
+
+    # Returned memoryview is only valid until the next register read
+    def _read_regs(self, addr, count):
+        if count > self.MAX_BLOCK_READ_LENGTH:
+            raise ValueError("Can read at most {} registers at once".format(self.MAX_BLOCK_READ_LENGTH))
+        return self._bus_read(addr & 0x7F, count)
 
     def _read_byte(self):
-        self.cs.off()
+        self._select()
         self.spi_bus.write(bytes([self.SINGLE_FIFO_READ]))
         data = self.spi_bus.read(1)
         data = self.spi_bus.read(1)
-        self.cs.on()
+        self._deselect()
         self.received_length -= 1
         return data
     
+    def _sensor_busy(self):
+        return (self._read_reg_value(self.CAM_REG_SENSOR_STATE) & 0x03) == self.CAM_REG_SENSOR_STATE_IDLE
+
+    def _sensor_idle(self):
+        return not self._sensor_busy()
+
+    def _capture_done(self):
+        return self._get_bit(self.ARDUCHIP_TRIG, self.CAP_DONE_MASK) != 0
+
     def _wait_idle(self):
-        data = self._read_reg(self.CAM_REG_SENSOR_STATE)
-        while ((int.from_bytes(data, 1) & 0x03) == self.CAM_REG_SENSOR_STATE_IDLE):
-            data = self._read_reg(self.CAM_REG_SENSOR_STATE)
-            sleep_ms(2)
+        waited = self._wait_until(self._sensor_idle, self.expected_idle_us, self.IDLE_TIMEOUT_MS, 'Sensor idle')
+        self.expected_idle_us = (3 * self.expected_idle_us + waited) // 4
+        self.last_idle_wait_us = waited
+        self.telemetry.record('idle_wait', waited)
+
+    # The resolution written for the capture being waited on, current_resolution_setting may have moved on since
+    def _capture_resolution(self):
+        return self.register_shadow.get(self.CAM_REG_CAPTURE_RESOLUTION, self.current_resolution_setting)
+
+    def _wait_capture_done(self):
+        resolution = self._capture_resolution()
+        expected = self.capture_time_estimates_us.get(resolution, 0)
+        self._record_capture_wait(resolution, expected, self._wait_until(self._capture_done, expected, self.CAPTURE_TIMEOUT_MS, 'Capture'))
+
+    async def _wait_idle_async(self):
+        waited = await self._wait_until_async(self._sensor_idle, self.expected_idle_us, self.IDLE_TIMEOUT_MS, 'Sensor idle')
+        self.expected_idle_us = (3 * self.expected_idle_us + waited) // 4
+        self.last_idle_wait_us = waited
+        self.telemetry.record('idle_wait', waited)
+
+    async def _wait_capture_done_async(self):
+        resolution = self._capture_resolution()
+        expected = self.capture_time_estimates_us.get(resolution, 0)
+        self._record_capture_wait(resolution, expected, await self._wait_until_async(self._capture_done, expected, self.CAPTURE_TIMEOUT_MS, 'Capture'))
+
+    def _record_capture_wait(self, resolution, expected, waited):
+        self.capture_time_estimates_us[resolution] = (3 * expected + waited) // 4 if expected else waited
+        self.last_capture_wait_us = waited
+        self.telemetry.record('capture_wait', waited)
+
+    def _poll_delay_us(self, elapsed_us, expected_us):
+        remaining = expected_us - elapsed_us
+        if remaining > self.POLL_TIGHT_WINDOW_US:
+            return remaining // 2
+        if remaining > 0:
+            return self.POLL_TIGHT_US
+        return min(self.POLL_MAX_US, self.POLL_TIGHT_US - remaining // 4)
+
+    # Polls done() until it returns True and returns the time waited (us)
+    def _wait_until(self, done, expected_us, timeout_ms, name):
+        start = utime.ticks_us()
+        while not done():
+            elapsed = utime.ticks_diff(utime.ticks_us(), start)
+            if elapsed > timeout_ms * 1000:
+                self.telemetry.count('timeouts')
+                raise CameraTimeoutError("{} did not finish within {}ms".format(name, timeout_ms))
+            sleep_us(self._poll_delay_us(elapsed, expected_us))
+        return utime.ticks_diff(utime.ticks_us(), start)
+
+    async def _wait_until_async(self, done, expected_us, timeout_ms, name):
+        start = utime.ticks_us()
+        while not done():
+            elapsed = utime.ticks_diff(utime.ticks_us(), start)
+            if elapsed > timeout_ms * 1000:
+                self.telemetry.count('timeouts')
+                raise CameraTimeoutError("{} did not finish within {}ms".format(name, timeout_ms))
+            await asyncio.sleep(self._poll_delay_us(elapsed, expected_us) / 1000000)
+        return utime.ticks_diff(utime.ticks_us(), start)
 
     def _get_bit(self, addr, bit):
-        data = self._read_reg(addr);
-        return int.from_bytes(data, 1) & bit;
-
-# SPIMODE0 is 0-Polarity and 0-Phase
-# SPIMODE1 is 0-Polarity and 1-Phase
-# SPIMODE2 is 1-Polarity and 0-Phase
-# SPIMODE3 is 1-Polarity and 1-Phase
-esp32SPI = SPI(1, baudrate=8000000, polarity=0, phase=1, bits=8, sck=machine.Pin(10), mosi=machine.Pin(11), miso=machine.Pin(12))
-esp32CS = Pin(13, Pin.OUT)
-esp32CS.high()
-
-camSPI = SPI(0,sck=Pin(18), miso=Pin(16), mosi=Pin(19), baudrate=8000000)
-camCS = Pin(17, Pin.OUT)
-
-# button = Pin(15, Pin.IN,Pin.PULL_UP)
-onboard_LED = Pin(25, Pin.OUT)
-
-cam = Camera(camSPI, camCS)
-# 320x240 1280x720
-cam.resolution = '1280x720'
-# cam.resolution('1280x720')
-cam.set_filter(cam.SPECIAL_REVERSE)
-cam.set_brightness_level(cam.BRIGHTNESS_PLUS_4)
-cam.set_contrast(cam.CONTRAST_MINUS_3)
-
-
-# onboard_LED.on()
-esp32CS.on()
-while True:
-    start_capture_time = time.ticks_ms()
-    cam.capture_jpg()
-    end_capture_time = time.ticks_ms()
-    i = 0
-
-    totalMessages = math.ceil(cam.received_length / cam.BUFFER_MAX_LENGTH)
-    readBuf1 = bytearray(cam.BUFFER_MAX_LENGTH)
-    readBuf2 = bytearray(cam.BUFFER_MAX_LENGTH)
-    metadataMessage = bytearray(cam.received_length.to_bytes(4) + totalMessages.to_bytes(4) + bytearray(cam.BUFFER_MAX_LENGTH - 8))
-    # Sending hardcoded data so the slave knows that this is metadata 
-    metadataMessage[-1] = 22
-    metadataMessage[-2] = 222
-    readyToBurstSend = False
-    start_handshake_time = time.ticks_ms()
-    esp32CS.off()
-    while readyToBurstSend is False:
+        return self._read_reg_value(addr) & bit
+
+
+'''
+An RGB565 or YUV frame read straight from the FIFO by Camera.capture_raw()
+* buffer is allocated once and reused by every frame that fits, data is a memoryview of the current frame
+* Row y starts at y * stride. RGB565 pixels are two bytes high byte first, YUV is Y0 U Y1 V per pixel pair
+'''
+class RawFrame:
+    def __init__(self, capacity):
+        self.buffer = bytearray(capacity)
+        self.buffer_mv = memoryview(self.buffer)
+        self.width = 0
+        self.height = 0
+        self.stride = 0
+        self.length = 0
+        self.pixel_format = None
+
+    @property
+    def data(self):
+        return self.buffer_mv[:self.length]
+
+    def row(self, y):
+        start = y * self.stride
+        return self.buffer_mv[start:start + self.stride]
+
+    # RGB565 value, or the Y byte of a YUV frame
+    def pixel(self, x, y):
+        index = y * self.stride + 2 * x
+        if self.pixel_format == Camera.CAM_IMAGE_PIX_FMT_YUV:
+            return self.buffer[index]
+        return (self.buffer[index] << 8) | self.buffer[index + 1]
+
+
+'''
+Finds the JPEG inside the FIFO chunks, markers may be split across two chunks
+'''
+class JpegFramer:
+    SOI = 0xD8
+    EOI = 0xD9
+    MARKER_PREFIX = b'\xff'
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.in_image = False
+        self.complete = False
+        self.last_byte_ff = False
+        self.payload_length = 0
+
+    # Writes the JPEG part of buffer[:length] to sink, returns True once EOI has been written
+    def feed(self, buffer, length, sink):
+        if self.complete or length == 0:
+            return self.complete
+
+        start = 0
+        search_from = 0
+        if not self.in_image:
+            if self.last_byte_ff and buffer[0] == self.SOI:
+                # The 0xFF of SOI was the last byte of the previous chunk
+                sink.write(self.MARKER_PREFIX)
+                self.payload_length += 1
+                search_from = 1
+            else:
+                start = find_marker(buffer, 0, length, self.SOI)
+                if start < 0:
+                    self.last_byte_ff = buffer[length - 1] == 0xFF
+                    return False
+                search_from = start + 2
+            self.in_image = True
+        elif self.last_byte_ff and buffer[0] == self.EOI:
+            return self._finish(buffer, 0, 1, sink)
+
+        end = find_marker(buffer, search_from, length, self.EOI)
+        if end >= 0:
+            return self._finish(buffer, start, end + 2, sink)
+
+        sink.write(buffer[start:length])
+        self.payload_length += length - start
+        self.last_byte_ff = buffer[length - 1] == 0xFF
+        return False
+
+    def _finish(self, buffer, start, end, sink):
+        sink.write(buffer[start:end])
+        self.payload_length += end - start
+        self.in_image = False
+        self.complete = True
+        return True
+
+
+'''
+Sinks receive the image from Camera.stream_fifo
+* begin() gets the FIFO length before the first chunk, end() the number of bytes written
+* A chunk is only valid until write() returns, copy anything that needs to be kept
+'''
+class StreamSink:
+    def begin(self, fifo_length):
+        pass
+
+    def write(self, chunk):
+        pass
+
+    def end(self, payload_length):
+        pass
+
+
+'''
+Writes the image to flash in whole filesystem blocks
+* Chunks are gathered in a preallocated block_size buffer (the filesystem block size by default) and only full
+  blocks are written, runs of whole blocks are written straight from the chunk. The tail is written at the end
+* The file is synced once at the end. With atomic the image is written to <filename>.tmp and renamed, so a
+  power loss never leaves a partial image under filename
+* filename can be changed between images to reuse the buffer
+'''
+class FileSink(StreamSink):
+    DEFAULT_BLOCK_SIZE = 4096
+    TEMP_SUFFIX = '.tmp'
+
+    def __init__(self, filename=None, block_size=None, atomic=True):
+        self.filename = filename
+        self.atomic = atomic
+        if block_size is None:
+            block_size = self._filesystem_block_size()
+        self.block_size = block_size
+        self.buffer = bytearray(block_size)
+        self.buffer_mv = memoryview(self.buffer)
+        self.fill = 0
+        self.file = None
+        self._path = None
+
+    def begin(self, fifo_length):
+        self._path = self.filename + self.TEMP_SUFFIX if self.atomic else self.filename
+        self.file = open(self._path, 'wb')
+        self.fill = 0
+
+    def write(self, chunk):
+        chunk = memoryview(chunk)
+        length = len(chunk)
+        offset = 0
+        while offset < length:
+            if self.fill == 0 and length - offset >= self.block_size:
+                blocks = (length - offset) // self.block_size * self.block_size
+                self.file.write(chunk[offset:offset + blocks])
+                offset += blocks
+                continue
+            count = min(self.block_size - self.fill, length - offset)
+            self.buffer_mv[self.fill:self.fill + count] = chunk[offset:offset + count]
+            self.fill += count
+            offset += count
+            if self.fill == self.block_size:
+                self.file.write(self.buffer)
+                self.fill = 0
+
+    def end(self, payload_length):
+        if self.fill:
+            self.file.write(self.buffer_mv[:self.fill])
+            self.fill = 0
+        self.file.flush()
+        if hasattr(uos, 'fsync'):
+            uos.fsync(self.file.fileno())
+        self.file.close()
+        self.file = None
+        if self.atomic:
+            uos.rename(self._path, self.filename)
+
+    def _filesystem_block_size(self):
+        try:
+            return uos.statvfs('/')[0] or self.DEFAULT_BLOCK_SIZE
+        except (OSError, AttributeError):
+            return self.DEFAULT_BLOCK_SIZE
+
+
+class SPISink(StreamSink):
+    def __init__(self, spi_bus, cs):
+        self.spi_bus = spi_bus
+        self.cs = cs
+
+    def begin(self, fifo_length):
+        self.cs.off()
+
+    def write(self, chunk):
+        self.spi_bus.write(chunk)
+
+    def end(self, payload_length):
+        self.cs.on()
+
+
+class BufferSink(StreamSink):
+    def __init__(self, size):
+        self.buffer = bytearray(size)
+        self.buffer_mv = memoryview(self.buffer)
+        self.length = 0
+
+    @property
+    def data(self):
+        return self.buffer_mv[:self.length]
+
+    def begin(self, fifo_length):
+        self.length = 0
+
+    def write(self, chunk):
+        end = self.length + len(chunk)
+        if end > len(self.buffer):
+            raise ValueError("Image does not fit in the {} byte buffer".format(len(self.buffer)))
+        self.buffer_mv[self.length:end] = chunk
+        self.length = end
+
+
+class TeeSink(StreamSink):
+    def __init__(self, *sinks):
+        self.sinks = sinks
+
+    def begin(self, fifo_length):
+        for sink in self.sinks:
+            sink.begin(fifo_length)
+
+    def write(self, chunk):
+        for sink in self.sinks:
+            sink.write(chunk)
+
+    def end(self, payload_length):
+        for sink in self.sinks:
+            sink.end(payload_length)
+
+
+'''
+Relays captured frames to the ESP32 over SPI
+* A metadata message (length, number of messages, magic bytes 222 22) is repeated until the ESP32 answers 222
+* The FIFO is then sent with CS held low, padded with zeros to a whole number of buffer_length messages
+* With jpeg_framing only SOI..EOI is sent. The metadata length is then the FIFO length (an upper bound) and a
+  trailing metadata message (magic bytes 222 23) in its own CS frame carries the JPEG length and number of messages
+* dual_core=True fills one buffer from the camera while the second core sends the other (ping-pong)
+* stream_pipelined() starts the next exposure once the FIFO is read. With jpeg_framing it polls the ESP32 with
+  probe messages (magic bytes 222 21, length 0) while it runs, so the metadata exchange normally succeeds first time
+* The trailer and probe messages need ESP32 firmware that knows them, so on PROTOCOL_LEGACY jpeg_framing is off
+  unless asked for and the deployed firmware gets the original metadata + whole FIFO messages.
+  SOI..EOI trimming is therefore OFF by default on the legacy link, the whole FIFO and its padding are sent.
+  The metadata cannot carry the trimmed length, the EOI is only found while the FIFO is read after the handshake
+* link_protocol=PROTOCOL_FRAMED uses linkproto instead: every chunk is its own message with a 16 byte
+  header and CRC32, and a chunk the ESP32 NACKs is resent on its own. None of the above magic messages
+  or padding are sent, a frame the link gives up on is counted in frames_dropped by stream_pipelined()
+* telemetry_every=N sends a telemetry snapshot to the ESP32 after every N pipelined frames (framed protocol)
+* calibrate_chunk_size() picks buffer_length at run time from measured throughput and free heap (framed protocol)
+'''
+class ESP32Relay(StreamSink):
+    HANDSHAKE_ACK = 222
+    METADATA_MAGIC = (222, 22)
+    TRAILER_MAGIC = (222, 23)
+    PROBE_MAGIC = (222, 21)
+
+    PROTOCOL_LEGACY = 0
+    PROTOCOL_FRAMED = linkproto.VERSION
+
+    # The legacy metadata exchange raises LinkError when the ESP32 has not answered 222 within this,
+    # wait_ready() stops probing after it
+    HANDSHAKE_TIMEOUT_MS = 1000
+
+    # Tried by calibrate_chunk_size(), largest first
+    CHUNK_SIZE_CANDIDATES = (8192, 4096, 2048, 1024, 512)
+    # Share of the free heap the chunk buffers may take
+    HEAP_BUDGET_FRACTION = 0.5
+
+    def __init__(self, spi_bus, cs, buffer_length=Camera.BUFFER_MAX_LENGTH, dual_core=True, jpeg_framing=None,
+                 link_protocol=PROTOCOL_LEGACY, resend_window=4, telemetry=None, telemetry_every=0):
+        self.spi_bus = spi_bus
+        self.cs = cs
+        self.buffer_length = buffer_length
+        self.dual_core = dual_core
+        # None is on for the framed protocol and off for the legacy one, see above
+        if jpeg_framing is None:
+            jpeg_framing = link_protocol != self.PROTOCOL_LEGACY
+        self.jpeg_framing = jpeg_framing
+        self.link_protocol = link_protocol
+        self.link = None
+        if link_protocol == self.PROTOCOL_FRAMED:
+            self.link = linkproto.LinkSender(spi_bus, cs, buffer_length, resend_window)
+
+        self.telemetry = telemetry if telemetry is not None else default_telemetry
+        self.telemetry.add_timer('link_write', 'handshake', 'ready_wait', 'frame')
+        self.telemetry.add_counter('link_bytes', 'retransmissions', 'frames_dropped', 'telemetry_trimmed', 'telemetry_dropped')
+        self.telemetry_every = telemetry_every
+        self._frames_relayed = 0
+        self.chunk_calibration = []
+
+        # Ping-pong buffers, one is filled from the camera while the other is sent
+        self.readBuf1 = bytearray(buffer_length)
+        self.readBuf2 = bytearray(buffer_length)
+        self.buffers = (self.readBuf1, self.readBuf2)
+        self._buffer_mvs = (memoryview(self.readBuf1), memoryview(self.readBuf2))
+
+        if self.link is None:
+            self._zero_padding = memoryview(bytearray(buffer_length))
+            self.metadataMessage = bytearray(buffer_length)
+            self.metadataMessage[-2] = self.METADATA_MAGIC[0]
+            self.metadataMessage[-1] = self.METADATA_MAGIC[1]
+            self.handshake_rx = bytearray(buffer_length)
+            self.trailerMessage = bytearray(buffer_length)
+            self.trailerMessage[-2] = self.TRAILER_MAGIC[0]
+            self.trailerMessage[-1] = self.TRAILER_MAGIC[1]
+            self.probeMessage = bytearray(buffer_length)
+            self.probeMessage[-2] = self.PROBE_MAGIC[0]
+            self.probeMessage[-1] = self.PROBE_MAGIC[1]
+
+        # Timings (ms) of the last frame
+        self.bytes_sent = 0
+        self.messages_sent = 0
+        self.cam_read_time = 0
+        self.link_write_time = 0
+        self.link_write_us = 0
+        self.handshake_time = 0
+        self.ready_wait_time = 0
+        self.frame_time = 0
+        self.retransmissions = 0
+        self.frames_dropped = 0
+        self.last_link_error = None
+        # Drains the FIFO of a frame the ESP32 never took
+        self._discard_sink = StreamSink()
+
+        # A buffer may be filled while its free lock is available and sent once its filled lock is released
+        self._free_locks = (_allocate_lock(), _allocate_lock())
+        self._filled_locks = (_allocate_lock(), _allocate_lock())
+        for lock in self._filled_locks:
+            lock.acquire()
+        self._frame_done_lock = _allocate_lock()
+        self._frame_done_lock.acquire()
+        self._lengths = [0, 0]
+        self._fill_index = 0
+        self._worker_running = False
+        self._link_error = None
+
+    # stream tags the frame for the ESP32 (framed protocol only), see DualStream
+    # Raises LinkError when the ESP32 does not take the frame, see HANDSHAKE_TIMEOUT_MS and LinkSender.max_polls
+    def handshake(self, received_length, stream=0):
+        total_messages = math.ceil(received_length / self.buffer_length)
+        start_handshake = utime.ticks_us()
+        if self.link is not None:
+            self.link.begin_frame(received_length, stream)
+        else:
+            self._prepare_metadata(received_length)
+            self.cs.off()
+            while not self._exchange_metadata():
+                self._check_deadline(start_handshake, 'Metadata handshake')
+            self.cs.on()
+        self.handshake_time = self._record('handshake', start_handshake)
+        return total_messages
+
+    # Same as handshake but yields to other uasyncio tasks while the ESP32 is not ready
+    async def handshake_async(self, received_length, stream=0):
+        total_messages = math.ceil(received_length / self.buffer_length)
+        start_handshake = utime.ticks_us()
+        if self.link is not None:
+            self.link.new_frame(received_length, stream)
+            while not self.link.send_start():
+                self.link.check_start()
+                await asyncio.sleep(0)
+        else:
+            self._prepare_metadata(received_length)
+            self.cs.off()
+            while not self._exchange_metadata():
+                self._check_deadline(start_handshake, 'Metadata handshake')
+                await asyncio.sleep(0)
+            self.cs.on()
+        self.handshake_time = self._record('handshake', start_handshake)
+        return total_messages
+
+    # Spins on probe messages until the ESP32 is ready for the next metadata message
+    def wait_ready(self):
+        start_wait = utime.ticks_us()
+        if self.link is not None:
+            self.link.wait_ready()
+        elif self.jpeg_framing:
+            self.cs.off()
+            while True:
+                self.spi_bus.write_readinto(self.probeMessage, self.handshake_rx)
+                # Gives up quietly, the metadata handshake of the next frame then times out and drops it
+                if self.handshake_rx[0] == self.HANDSHAKE_ACK or self._past_deadline(start_wait):
+                    break
+            self.cs.on()
+        self.ready_wait_time = self._record('ready_wait', start_wait)
+
+    # Reallocates the ping-pong and link buffers, only between frames. The legacy ESP32 firmware has a fixed size
+    def set_buffer_length(self, buffer_length):
+        if self.link is None:
+            raise ValueError("Changing the message size needs link_protocol=PROTOCOL_FRAMED")
+        self.buffer_length = buffer_length
+        self.readBuf1 = self.readBuf2 = self.buffers = self._buffer_mvs = None
+        self.link.set_chunk_size(buffer_length)
+        self.readBuf1 = bytearray(buffer_length)
+        self.readBuf2 = bytearray(buffer_length)
+        self.buffers = (self.readBuf1, self.readBuf2)
+        self._buffer_mvs = (memoryview(self.readBuf1), memoryview(self.readBuf2))
+
+    '''
+    Times the transfer of frames at each candidate chunk size and keeps the fastest that fits the heap budget
+    * A chunk size costs (window + 4) chunks of heap, the burst buffer, both ping-pong buffers, the link window
+      and its receive buffer. heap_budget defaults to HEAP_BUDGET_FRACTION of the free heap
+    * The ESP32 may lower the size in its reply to START, chunks are then split to its limit. Sizes above
+      that limit (link.peer_max_chunk) are skipped, they would only be measured at the limit
+    * Frames are captured at the current resolution, the result is per resolution
+    * Returns the chosen size, chunk_calibration holds (size, MB/s) of every size tried
+    '''
+    def calibrate_chunk_size(self, cam, candidates=CHUNK_SIZE_CANDIDATES, frames=2, heap_budget=None):
+        if self.link is None:
+            raise ValueError("Chunk size calibration needs link_protocol=PROTOCOL_FRAMED")
+        chunk_buffers = self.link.window + 4
+        if heap_budget is None:
+            heap_budget = self._heap_budget(cam, chunk_buffers)
+
+        self.chunk_calibration = []
+        best_size = self.buffer_length
+        best_rate = 0
+        for size in candidates:
+            if heap_budget is not None and size * chunk_buffers > heap_budget:
+                continue
+            if self._above_peer_limit(size):
+                continue
+            cam.set_burst_length(size)
+            self.set_buffer_length(size)
+            sent = 0
+            elapsed = 0
+            for i in range(frames):
+                cam.capture_jpg()
+                start_transfer = utime.ticks_us()
+                self.handshake(cam.received_length)
+                sent += self.send_frame(cam)
+                elapsed += utime.ticks_diff(utime.ticks_us(), start_transfer)
+            # The first START at this size can be what reports the ESP32's limit, the frames then went at the limit
+            if self._above_peer_limit(size):
+                continue
+            rate = sent / max(1, elapsed)
+            self.chunk_calibration.append((size, rate))
+            if rate > best_rate:
+                best_size = size
+                best_rate = rate
+
+        if self._above_peer_limit(best_size):
+            best_size = self.link.peer_max_chunk
+        cam.set_burst_length(best_size)
+        self.set_buffer_length(best_size)
+        return best_size
+
+    def _above_peer_limit(self, size):
+        return self.link.peer_max_chunk is not None and size > self.link.peer_max_chunk
+
+    # None when the heap size is unknown (host CPython)
+    def _heap_budget(self, cam, chunk_buffers):
+        if not hasattr(gc, 'mem_free'):
+            return None
+        gc.collect()
+        # The current buffers are freed before the new ones are allocated
+        in_use = cam.burst_length + (chunk_buffers - 1) * self.buffer_length
+        return int((gc.mem_free() + in_use) * self.HEAP_BUDGET_FRACTION)
+
+    '''
+    Sends a telemetry snapshot as one link message, framed protocol only
+    * Best effort, it never raises into the frame loop. A snapshot larger than the chunk size loses timers
+      from the end of the name order until it fits (counted in telemetry_trimmed), one that still does not
+      fit or fails on the link is counted in telemetry_dropped
+    '''
+    def send_telemetry(self):
+        if self.link is None:
+            raise ValueError("Telemetry needs link_protocol=PROTOCOL_FRAMED")
+        snapshot = self.telemetry.snapshot()
+        payload = ujson.dumps(snapshot).encode()
+        if len(payload) > self.link.chunk_size:
+            self.telemetry.count('telemetry_trimmed')
+            names = sorted(snapshot['timers'])
+            while len(payload) > self.link.chunk_size and names:
+                del snapshot['timers'][names.pop()]
+                payload = ujson.dumps(snapshot).encode()
+        if len(payload) > self.link.chunk_size:
+            self.telemetry.count('telemetry_dropped')
+            return
+        try:
+            self.link.send_telemetry(payload)
+        except linkproto.LinkError:
+            self.telemetry.count('telemetry_dropped')
+
+    # One exchange with the ESP32, True if it can take the next frame. Does not wait, see FrameScheduler
+    def poll_ready(self):
+        if self.link is not None:
+            return self.link.poll()
+        if not self.jpeg_framing:
+            # Firmware without probe messages, the metadata exchange waits instead
+            return True
+        self.cs.off()
+        self.spi_bus.write_readinto(self.probeMessage, self.handshake_rx)
+        self.cs.on()
+        return self.handshake_rx[0] == self.HANDSHAKE_ACK
+
+    def send_frame(self, cam):
+        cam.stream_fifo(self, jpeg_framing=self.jpeg_framing)
+        self.cam_read_time = cam.fifo_read_time
+        return self.bytes_sent
+
+    '''
+    Handshake and stream the captured FIFO of cam as one frame, returns the number of image bytes sent
+    * A frame the link gives up on is counted in frames_dropped, the FIFO has still been drained and
+      on_drained called, it cannot be read twice
+    * Every telemetry_every frames a telemetry snapshot follows the frame
+    '''
+    def relay_frame(self, cam, on_drained=None, stream=0):
+        try:
+            self.handshake(cam.received_length, stream)
+        except linkproto.LinkError as e:
+            self._drop_frame(e)
+            # Drained all the same, so a pipelined capture is still started
+            self.bytes_sent = 0
+            cam.stream_fifo(self._discard_sink, on_drained=on_drained)
+        else:
+            try:
+                cam.stream_fifo(self, jpeg_framing=self.jpeg_framing, on_drained=on_drained)
+            except linkproto.LinkError as e:
+                self._drop_frame(e)
+        self.cam_read_time = cam.fifo_read_time
+
+        self._frames_relayed += 1
+        if self.telemetry_every and self._frames_relayed % self.telemetry_every == 0:
+            self.send_telemetry()
+        return self.bytes_sent
+
+    '''
+    Capture and send one frame per scheduler slot, yields the number of image bytes after each frame
+    * The scheduler is given poll_ready() so a slot is dropped while the ESP32 is still busy
+    '''
+    def stream_scheduled(self, cam, scheduler):
+        scheduler.ready = self.poll_ready
+        while True:
+            scheduler.wait()
+            start_frame = utime.ticks_us()
+            cam.capture_jpg()
+            self.relay_frame(cam)
+            self.frame_time = self._record('frame', start_frame)
+            yield self.bytes_sent
+
+    '''
+    Capture and send frames forever, yields the number of image bytes after each frame
+    * Frame N+1 is exposing while the last messages of frame N are sent and the ESP32 gets ready
+    '''
+    def stream_pipelined(self, cam):
+        start_frame = utime.ticks_us()
+        cam.trigger_capture()
+        while True:
+            cam.wait_capture()
+            self.relay_frame(cam, on_drained=cam.trigger_capture)
+            self.wait_ready()
+
+            self.frame_time = self._record('frame', start_frame)
+            start_frame = utime.ticks_us()
+            yield self.bytes_sent
+
+    async def send_frame_async(self, cam):
+        await cam.stream_fifo_async(self, jpeg_framing=self.jpeg_framing)
+        self.cam_read_time = cam.fifo_read_time
+        return self.bytes_sent
+
+    def _drop_frame(self, error):
+        self.frames_dropped += 1
+        self.last_link_error = error
+        self.telemetry.count('frames_dropped')
+
+    # Records the time since start in telemetry, returns it in ms for the per frame timings
+    def _record(self, name, start):
+        elapsed = utime.ticks_diff(utime.ticks_us(), start)
+        self.telemetry.record(name, elapsed)
+        return elapsed // 1000
+
+    def _past_deadline(self, start):
+        return utime.ticks_diff(utime.ticks_us(), start) > self.HANDSHAKE_TIMEOUT_MS * 1000
+
+    # Like Camera._wait_until, releases CS so the next frame starts a new transaction
+    def _check_deadline(self, start, name):
+        if self._past_deadline(start):
+            self.cs.on()
+            raise linkproto.LinkError("{} was not answered within {}ms".format(name, self.HANDSHAKE_TIMEOUT_MS))
+
+    def _prepare_metadata(self, received_length):
+        total_messages = math.ceil(received_length / self.buffer_length)
+        self.metadataMessage[0:4] = received_length.to_bytes(4, 'big')
+        self.metadataMessage[4:8] = total_messages.to_bytes(4, 'big')
+
+    def _exchange_metadata(self):
         # We need a write read to ensure a full duplex transaction is made
-        esp32SPI.write_readinto(metadataMessage, readBuf1)
+        self.spi_bus.write_readinto(self.metadataMessage, self.handshake_rx)
         # Checking for a valid slave response, expect the slave to send back a nothing but 222
-        if readBuf1[0] == 222:
-            readyToBurstSend = True
-    esp32CS.on()
-    end_handshake_time = time.ticks_ms()
-    
-    start_transaction_time = time.ticks_ms()
-    cam.first_burst_fifo = True
-    esp32CS.off()
-    cam_total_read_time = 0
-    slave_total_write_time = 0
-    while(cam.received_length):
-#         cam._burst_read_FIFO()
-        start_cam_read = time.ticks_ms()
-        cam._burst_read_FIFO_faster()
-        end_cam_read = time.ticks_ms()
-        start_slave_write = time.ticks_ms()
-        esp32SPI.write(cam.image_buffer)
-        end_slave_write = time.ticks_ms()
-        cam_total_read_time += end_cam_read - start_cam_read
-        slave_total_write_time += end_slave_write - start_slave_write
-        i += 1
-    esp32CS.on()
-    print(f"sent messages: {i}")
-    print(f"cam transaction duration: {cam_total_read_time}")
-    print(f"slave transaction duration: {slave_total_write_time}")
-    print(f"handshake duration: {end_handshake_time - start_handshake_time}")
-    print(f"capture duration: {end_capture_time - start_capture_time}")
+        return self.handshake_rx[0] == self.HANDSHAKE_ACK
+
+########### StreamSink ###########
+    def begin(self, fifo_length):
+        self.bytes_sent = 0
+        self.messages_sent = 0
+        self.link_write_us = 0
+        if self.dual_core and not self._worker_running:
+            self._worker_running = True
+            _start_worker(self._link_worker)
+        self._fill_index = 0
+        self._link_error = None
+        if self.link is None:
+            self.cs.off()
+
+    def write(self, chunk):
+        length = len(chunk)
+        if not self.dual_core:
+            if self._link_error is not None:
+                return
+            start_slave_write = utime.ticks_us()
+            try:
+                self._send_chunk(chunk)
+            except Exception as e:
+                self._link_error = e
+                return
+            write_us = utime.ticks_diff(utime.ticks_us(), start_slave_write)
+            self.link_write_us += write_us
+            self.telemetry.record('link_write', write_us)
+            self.bytes_sent += length
+            return
+
+        index = self._fill_index
+        self._free_locks[index].acquire() # Wait for the worker to finish sending this buffer
+        self._buffer_mvs[index][:length] = chunk
+        self._lengths[index] = length
+        self._filled_locks[index].release()
+        self._fill_index = index ^ 1
+
+    def end(self, payload_length):
+        if self.dual_core:
+            # An empty buffer marks the end of the frame
+            index = self._fill_index
+            self._free_locks[index].acquire()
+            self._lengths[index] = 0
+            self._filled_locks[index].release()
+            self._frame_done_lock.acquire()
+        self.link_write_time = self.link_write_us // 1000
+        self.telemetry.count('link_bytes', self.bytes_sent)
+        if self._link_error is not None:
+            raise self._link_error
+
+        if self.link is not None:
+            self.link.end_frame(payload_length)
+            self.messages_sent = self.link.chunks_sent
+            self.retransmissions = self.link.retransmissions
+            self.telemetry.count('retransmissions', self.retransmissions)
+            return
+
+        padding = -self.bytes_sent % self.buffer_length
+        if padding:
+            self.spi_bus.write(self._zero_padding[:padding])
+        self.cs.on()
+        self.messages_sent = (self.bytes_sent + padding) // self.buffer_length
+
+        if self.jpeg_framing:
+            self.trailerMessage[0:4] = payload_length.to_bytes(4, 'big')
+            self.trailerMessage[4:8] = self.messages_sent.to_bytes(4, 'big')
+            self.cs.off()
+            self.spi_bus.write(self.trailerMessage)
+            self.cs.on()
+
+    def _link_worker(self):
+        index = 0
+        while True:
+            self._filled_locks[index].acquire()
+            length = self._lengths[index]
+            if length == 0:
+                self._free_locks[index].release()
+                index = 0
+                self._frame_done_lock.release()
+                continue
+
+            # After a link error the FIFO is still drained but nothing more is sent, end() raises the error
+            if self._link_error is None:
+                start_slave_write = utime.ticks_us()
+                try:
+                    if length == self.buffer_length:
+                        self._send_chunk(self.buffers[index])
+                    else:
+                        self._send_chunk(self._buffer_mvs[index][:length])
+                except Exception as e:
+                    self._link_error = e
+                write_us = utime.ticks_diff(utime.ticks_us(), start_slave_write)
+                self.link_write_us += write_us
+                self.telemetry.record('link_write', write_us)
+                self.bytes_sent += length
+            self._free_locks[index].release()
+            index ^= 1
+
+    def _send_chunk(self, chunk):
+        if self.link is None:
+            self.spi_bus.write(chunk)
+            return
+        chunk_size = self.link.chunk_size
+        if len(chunk) <= chunk_size:
+            self.link.send_chunk(chunk)
+            return
+        # The ESP32 asked for smaller chunks than the camera bursts
+        chunk = memoryview(chunk)
+        for start in range(0, len(chunk), chunk_size):
+            self.link.send_chunk(chunk[start:start + chunk_size])
 
 
-    
+'''
+Paces captures to a fixed interval, e.g. FrameScheduler(500) for 2 fps or FrameScheduler(10000) for a time-lapse
+* Frame n is due at start + n * interval_ms, wait() sleeps until the next slot instead of spinning
+  (lightsleep for sleeps of at least LIGHTSLEEP_MIN_MS when light_sleep is set, USB serial stops during it)
+* A slot that cannot be started within late_tolerance_ms (default half an interval) is a missed deadline.
+  drop_late skips it and waits for the next slot on the grid, otherwise the frame is taken late and the
+  grid restarts from now
+* ready() is polled every READY_POLL_MS once a slot is due. While it returns False (e.g. the ESP32 is still
+  busy with the previous frame) the frame waits up to late_tolerance_ms and is then dropped as a missed deadline
+* Counters: frames, missed_deadlines and dropped_frames, also in telemetry with the lateness timer (us)
+'''
+class FrameScheduler:
+    READY_POLL_MS = 2
+    LIGHTSLEEP_MIN_MS = 50
+
+    def __init__(self, interval_ms, ready=None, drop_late=True, late_tolerance_ms=None, light_sleep=False, telemetry=None):
+        self.interval_ms = interval_ms
+        self.ready = ready
+        self.drop_late = drop_late
+        self.late_tolerance_ms = late_tolerance_ms if late_tolerance_ms is not None else interval_ms // 2
+        self.light_sleep = light_sleep
+        self.telemetry = telemetry if telemetry is not None else default_telemetry
+        self.telemetry.add_timer('lateness')
+        self.telemetry.add_counter('missed_deadlines', 'dropped_frames')
+
+        self.frames = 0
+        self.missed_deadlines = 0
+        self.dropped_frames = 0
+        self.last_lateness_ms = 0
+        self.next_due = None
+
+    def reset(self):
+        self.next_due = None
+
+    # Returns when the next frame should be captured
+    def wait(self):
+        if self.next_due is None:
+            self.next_due = utime.ticks_ms()
+        while True:
+            late = utime.ticks_diff(utime.ticks_ms(), self.next_due)
+            if late < 0:
+                self._sleep(-late)
+                continue
+
+            if late > self.late_tolerance_ms:
+                self._miss(late)
+                continue
+
+            if self.ready is not None and not self.ready():
+                self._sleep(min(self.READY_POLL_MS, self.late_tolerance_ms - late + 1))
+                continue
+
+            self.frames += 1
+            self.last_lateness_ms = late
+            self.telemetry.record('lateness', late * 1000)
+            self.next_due = utime.ticks_add(self.next_due, self.interval_ms)
+            return
+
+    def _miss(self, late):
+        self.missed_deadlines += 1
+        self.telemetry.count('missed_deadlines')
+        if not self.drop_late and (self.ready is None or self.ready()):
+            # Take the frame now and keep the interval from here
+            self.next_due = utime.ticks_ms()
+            return
+        # Skip every slot that has already passed
+        skipped = late // self.interval_ms + 1
+        self.dropped_frames += skipped
+        self.telemetry.count('dropped_frames', skipped)
+        self.next_due = utime.ticks_add(self.next_due, skipped * self.interval_ms)
+
+    def _sleep(self, ms):
+        if self.light_sleep and ms >= self.LIGHTSLEEP_MIN_MS:
+            lightsleep(ms)
+        else:
+            sleep_ms(ms)
+
+
+'''
+Keeps frames within a byte and/or link time budget, stepping the JPEG quality first and then the resolution
+* Call update(image_bytes, link_us) after every frame, e.g. with relay.link_write_us. Each frame's load is the
+  larger of image_bytes / max_bytes and link_us / max_ms
+* The steps start at the resolution set when the controller is created at IMAGE_QUALITY_HIGH, go down through
+  the lower qualities and then through the smaller resolutions of the sensor's table (down to min_resolution)
+  at IMAGE_QUALITY_LOW. Square resolutions are left out
+* Decisions use the mean load of the last window frames, the window restarts after each step and the next
+  settle_frames are ignored, with stream_pipelined the frame after a step was already triggered
+* Steps down when the mean load is over 1, up when the mean load times the expected growth of the step up
+  (QUALITY_GROWTH or the pixel ratio) stays under upgrade_margin
+'''
+class RateController:
+    QUALITY_STEPS = (Camera.IMAGE_QUALITY_HIGH, Camera.IMAGE_QUALITY_MEDI, Camera.IMAGE_QUALITY_LOW)
+    # Expected size ratio of one quality step up
+    QUALITY_GROWTH = 1.5
+    WINDOW = 4
+    SETTLE_FRAMES = 1
+    UPGRADE_MARGIN = 0.8
+
+    def __init__(self, cam, max_bytes=None, max_ms=None, min_resolution='320x240', window=WINDOW,
+                 settle_frames=SETTLE_FRAMES, upgrade_margin=UPGRADE_MARGIN, telemetry=None):
+        if max_bytes is None and max_ms is None:
+            raise ValueError("Set max_bytes and/or max_ms")
+        self.cam = cam
+        self.max_bytes = max_bytes
+        self.max_ms = max_ms
+        self.window = window
+        self.settle_frames = settle_frames
+        self.upgrade_margin = upgrade_margin
+        self.telemetry = telemetry if telemetry is not None else default_telemetry
+        self.telemetry.add_counter('rate_steps_down', 'rate_steps_up')
+
+        self.steps = self._build_steps(min_resolution.lower())
+        self.step = 0
+        self.samples = []
+        self.last_load = 0
+        self._settling = 0
+        self._apply_step()
+
+    @property
+    def resolution(self):
+        return self.steps[self.step][0]
+
+    @property
+    def quality(self):
+        return self.steps[self.step][1]
+
+    # Returns True when the camera settings were changed
+    def update(self, image_bytes, link_us=0):
+        if self._settling:
+            self._settling -= 1
+            return False
+        self.samples.append(self._load(image_bytes, link_us))
+        if len(self.samples) > self.window:
+            self.samples.pop(0)
+        if len(self.samples) < self.window:
+            return False
+
+        load = sum(self.samples) / len(self.samples)
+        self.last_load = load
+        if load > 1 and self.step < len(self.steps) - 1:
+            self.step += 1
+            self.telemetry.count('rate_steps_down')
+        elif self.step > 0 and load * self._growth(self.step - 1) < self.upgrade_margin:
+            self.step -= 1
+            self.telemetry.count('rate_steps_up')
+        else:
+            return False
+        self._apply_step()
+        return True
+
+    def _load(self, image_bytes, link_us):
+        load = 0
+        if self.max_bytes:
+            load = image_bytes / self.max_bytes
+        if self.max_ms:
+            load = max(load, link_us / (self.max_ms * 1000))
+        return load
+
+    # Size ratio of steps[step] over steps[step + 1]
+    def _growth(self, step):
+        resolution, quality = self.steps[step]
+        lower_resolution, lower_quality = self.steps[step + 1]
+        if resolution == lower_resolution:
+            return self.QUALITY_GROWTH
+        return _pixels(resolution) / _pixels(lower_resolution)
+
+    def _apply_step(self):
+        resolution, quality = self.steps[self.step]
+        self.cam.resolution = resolution
+        self.cam.set_image_quality(quality)
+        self.samples = []
+        self._settling = self.settle_frames
+
+    def _build_steps(self, min_resolution):
+        cam = self.cam
+        valid = cam.valid_5mp_resolutions if cam.camera_idx == '5MP' else cam.valid_3mp_resolutions
+        current = None
+        for name in valid:
+            if valid[name] == cam.current_resolution_setting:
+                current = name
+        if current is None:
+            raise ValueError("Set a resolution from {} before creating the controller".format(list(valid.keys())))
+
+        smaller = []
+        for name in valid:
+            width, height = name.split('x')
+            if width != height and _pixels(min_resolution) <= _pixels(name) < _pixels(current):
+                smaller.append(name)
+        smaller.sort(key=_pixels, reverse=True)
+
+        steps = []
+        for quality in self.QUALITY_STEPS:
+            steps.append((current, quality))
+        for name in smaller:
+            steps.append((name, self.QUALITY_STEPS[-1]))
+        return steps
+
+
+def _pixels(resolution):
+    width, height = resolution.split('x')
+    return int(width) * int(height)
 
 
+'''
+A low resolution preview stream with a full resolution still every still_every frames or after request_still()
+* Both profiles (resolution and optional JPEG quality) are checked once up front, switching only sets the
+  camera's capture settings. The register shadow then writes just the registers that differ in one batch
+  with one idle wait, and frames of the same stream write nothing
+* switch_us and switch_writes hold the prepare time and register writes of the last switch, the
+  'stream_switch' timer keeps the distribution
+* relay_pipelined() tags each frame with STREAM_PREVIEW or STREAM_STILL in the link's START and END messages
+'''
+class DualStream:
+    STREAM_PREVIEW = 0
+    STREAM_STILL = 1
+
+    def __init__(self, cam, preview='320x240', still='1280x720', preview_quality=None, still_quality=None,
+                 still_every=0, telemetry=None):
+        self.cam = cam
+        # Once one profile sets the quality the other must too, or it would keep that quality
+        if preview_quality is not None or still_quality is not None:
+            if preview_quality is None:
+                preview_quality = cam.IMAGE_QUALITY_HIGH
+            if still_quality is None:
+                still_quality = cam.IMAGE_QUALITY_HIGH
+        self.profiles = {
+            self.STREAM_PREVIEW: (cam.resolution_value(preview), preview_quality),
+            self.STREAM_STILL: (cam.resolution_value(still), still_quality)
+        }
+        self.still_every = still_every
+        self.telemetry = telemetry if telemetry is not None else default_telemetry
+        self.telemetry.add_timer('stream_switch')
+        self.telemetry.add_counter('preview_frames', 'still_frames')
+
+        self.stream = None
+        self.still_requested = False
+        self.previews_since_still = 0
+        self.switches = 0
+        self.switch_us = 0
+        self.switch_writes = 0
+
+    # The next frame is a still, on the next trigger or, with relay_pipelined, the one after it
+    def request_still(self):
+        self.still_requested = True
+
+    def next_stream(self):
+        if self.still_requested:
+            return self.STREAM_STILL
+        if self.still_every and self.previews_since_still >= self.still_every:
+            return self.STREAM_STILL
+        return self.STREAM_PREVIEW
+
+    # Starts a capture for the next stream and returns that stream
+    def trigger(self):
+        stream = self.next_stream()
+        if stream == self.STREAM_STILL:
+            self.still_requested = False
+            self.previews_since_still = 0
+            self.telemetry.count('still_frames')
+        else:
+            self.previews_since_still += 1
+            self.telemetry.count('preview_frames')
+
+        resolution, quality = self.profiles[stream]
+        self.cam.current_resolution_setting = resolution
+        if quality is not None:
+            self.cam.set_image_quality(quality)
+
+        start_prepare = utime.ticks_us()
+        self.cam.prepare_capture()
+        if stream != self.stream:
+            self.switches += 1
+            self.switch_us = utime.ticks_diff(utime.ticks_us(), start_prepare)
+            self.switch_writes = self.cam.settings_written
+            self.telemetry.record('stream_switch', self.switch_us)
+        self.stream = stream
+        self.cam.start_capture()
+        return stream
+
+    # Captures one frame, returns its stream
+    def capture(self):
+        stream = self.trigger()
+        self.cam.wait_capture()
+        return stream
+
+    '''
+    Capture and send frames forever, the next capture starts once the FIFO is drained as in stream_pipelined
+    * Yields (stream, image bytes) after each frame
+    '''
+    def relay_pipelined(self, relay):
+        self.trigger()
+        while True:
+            self.cam.wait_capture()
+            captured = self.stream
+            relay.relay_frame(self.cam, on_drained=self.trigger, stream=captured)
+            relay.wait_ready()
+            yield captured, relay.bytes_sent
 
 
+'''
+Sends a full resolution JPEG only when a small YUV frame shows motion
+* check() captures a raw YUV frame at detect_resolution (96x96 or 128x128) and sums the luma of each
+  block x block tile. The tiles are compared with a running background of the same sums
+* Motion is at least min_blocks tiles whose mean luma differs from the background by more than threshold
+* The background moves 1 / 2**background_shift of the way to every checked frame, so light changes and
+  objects that stay are absorbed after a few checks
+* relay() checks once per scheduler slot (or back to back without one) and yields the image bytes of each
+  JPEG sent, the idle checks only show up in telemetry
+'''
+class MotionGate:
+    def __init__(self, cam, still='1280x720', detect_resolution='96x96', block=8, threshold=12, min_blocks=2,
+                 background_shift=3, telemetry=None):
+        self.cam = cam
+        self.still_resolution = cam.resolution_value(still)
+        self.detect_resolution = cam.resolution_value(detect_resolution)
+        size = cam.RAW_RESOLUTION_SIZES.get(self.detect_resolution)
+        if size is None:
+            raise ValueError("Motion detection needs a raw resolution (96x96, 128x128 or 320x240)")
+        self.width, self.height = size
+        if self.width % block or self.height % block:
+            raise ValueError("block must divide {}x{}".format(self.width, self.height))
+        self.block = block
+        self.blocks_x = self.width // block
+        self.threshold = threshold
+        self.min_blocks = min_blocks
+        self.background_shift = background_shift
+        self.telemetry = telemetry if telemetry is not None else default_telemetry
+        self.telemetry.add_timer('motion_check', 'motion_compare')
+        self.telemetry.add_counter('motion_checks', 'motion_triggers')
+
+        # Allocated once, every check reuses them
+        block_count = self.blocks_x * (self.height // block)
+        self.frame = RawFrame(self.width * self.height * 2)
+        self.sums = array('l', [0] * block_count)
+        self.background = array('l', [0] * block_count)
+        self.has_background = False
+        self.changed_blocks = 0
+
+    # Returns True when the scene changed
+    def check(self):
+        start_check = utime.ticks_us()
+        cam = self.cam
+        cam.set_pixel_format(cam.CAM_IMAGE_PIX_FMT_YUV)
+        cam.current_resolution_setting = self.detect_resolution
+        frame = cam.capture_raw(self.frame)
+
+        start_compare = utime.ticks_us()
+        block_luma_sums(frame.buffer, self.width, self.height, frame.stride, self.block, self.sums)
+        self.changed_blocks = self._update_background()
+        self.telemetry.lap('motion_compare', start_compare)
+        self.telemetry.lap('motion_check', start_check)
+        self.telemetry.count('motion_checks')
+
+        motion = self.changed_blocks >= self.min_blocks
+        if motion:
+            self.telemetry.count('motion_triggers')
+        return motion
+
+    # Full resolution JPEG, read it with stream_fifo / saveJPG as usual
+    def capture_still(self):
+        cam = self.cam
+        cam.set_pixel_format(cam.CAM_IMAGE_PIX_FMT_JPG)
+        cam.current_resolution_setting = self.still_resolution
+        cam.capture_jpg()
+
+    def relay(self, relay, scheduler=None):
+        while True:
+            if scheduler is not None:
+                scheduler.wait()
+            if self.check():
+                self.capture_still()
+                relay.relay_frame(self.cam)
+                relay.wait_ready()
+                yield relay.bytes_sent
+
+    # Counts the blocks over threshold, then moves the background towards the sums
+    def _update_background(self):
+        sums = self.sums
+        background = self.background
+        if not self.has_background:
+            for i in range(len(sums)):
+                background[i] = sums[i]
+            self.has_background = True
+            return 0
+
+        limit = self.threshold * self.block * self.block
+        shift = self.background_shift
+        changed = 0
+        for i in range(len(sums)):
+            difference = sums[i] - background[i]
+            if difference > limit or difference < -limit:
+                changed += 1
+            background[i] += difference >> shift if difference >= 0 else -((-difference) >> shift)
+        return changed
+
+
+'''
+Several ArduCam Megas on one SPI bus, each with its own CS
+* trigger_all() prepares every sensor (settings, FIFO flag, idle) and then writes the capture triggers back
+  to back without write pacing, so the exposures start within trigger_skew_us of each other. The pacing
+  is waited once after the last trigger
+* stream_all() drains the FIFOs in camera order, or with interleave one chunk from each in turn
+* relay_pipelined() sends each set as consecutive frames in camera order, tagged with the camera index as
+  their stream, and triggers the next set once the last FIFO is drained
+* The cameras need a shared bus_lock only when another thread also uses the bus
+'''
+class MultiCamera:
+    def __init__(self, cameras):
+        self.cameras = cameras
+        self.trigger_skew_us = 0
+
+    def trigger_all(self):
+        for cam in self.cameras:
+            # Like capture_jpg, a fast_start 5MP module is not triggered inside its white balance window
+            if cam.fast_start:
+                cam.wait_white_balance()
+            cam.prepare_capture()
+        start_trigger = utime.ticks_us()
+        for cam in self.cameras:
+            cam.start_capture(pace=False)
+        self.trigger_skew_us = utime.ticks_diff(utime.ticks_us(), start_trigger)
+        pacing_us = 0
+        for cam in self.cameras:
+            pacing_us = max(pacing_us, cam.write_pacing_us)
+        if pacing_us:
+            sleep_us(pacing_us)
+
+    def wait_all(self):
+        for cam in self.cameras:
+            cam.wait_capture()
+
+    def capture_all(self):
+        self.trigger_all()
+        self.wait_all()
+
+    # One sink per camera, returns the number of bytes written to each
+    def stream_all(self, sinks, jpeg_framing=True, interleave=False, on_drained=None):
+        last = len(self.cameras) - 1
+        if not interleave:
+            lengths = []
+            for i in range(len(self.cameras)):
+                lengths.append(self.cameras[i].stream_fifo(sinks[i], jpeg_framing, on_drained if i == last else None))
+            return lengths
+
+        framers = []
+        for i in range(len(self.cameras)):
+            framers.append(self.cameras[i]._begin_stream(sinks[i], jpeg_framing))
+        draining = True
+        while draining:
+            draining = False
+            for i in range(len(self.cameras)):
+                cam = self.cameras[i]
+                if cam.received_length:
+                    cam._stream_chunk(sinks[i], framers[i])
+                    draining = True
+        lengths = []
+        for i in range(len(self.cameras)):
+            lengths.append(self.cameras[i]._end_stream(sinks[i], framers[i], on_drained if i == last else None))
+        return lengths
+
+    # Yields the image bytes sent for each camera after every set
+    def relay_pipelined(self, relay):
+        last = len(self.cameras) - 1
+        self.trigger_all()
+        while True:
+            self.wait_all()
+            sizes = []
+            for i in range(len(self.cameras)):
+                sizes.append(relay.relay_frame(self.cameras[i], on_drained=self.trigger_all if i == last else None, stream=i))
+            relay.wait_ready()
+            yield sizes
+
+
+if __name__ == '__main__':
+    # SPIMODE0 is 0-Polarity and 0-Phase
+    # SPIMODE1 is 0-Polarity and 1-Phase
+    # SPIMODE2 is 1-Polarity and 0-Phase
+    # SPIMODE3 is 1-Polarity and 1-Phase
+    esp32SPI = SPI(1, baudrate=8000000, polarity=0, phase=1, bits=8, sck=Pin(10), mosi=Pin(11), miso=Pin(12))
+    esp32CS = Pin(13, Pin.OUT)
+    esp32CS.high()
+
+    camSPI = SPI(0,sck=Pin(18), miso=Pin(16), mosi=Pin(19), baudrate=8000000)
+    camCS = Pin(17, Pin.OUT, value=1)
+    # CS pins of further ArduCams on camSPI, their frames follow this camera's in each set
+    EXTRA_CAMERA_CS_PINS = ()
+    # Every CS is driven high before the first camera is reset so the other modules ignore its traffic
+    extra_camera_cs = []
+    for pin in EXTRA_CAMERA_CS_PINS:
+        extra_camera_cs.append(Pin(pin, Pin.OUT, value=1))
+
+    # button = Pin(15, Pin.IN,Pin.PULL_UP)
+    onboard_LED = Pin(25, Pin.OUT)
+
+    # The first boot calibrates the write pacing and saves a profile, the next ones skip the sensor probe and calibration
+    CAMERA_PROFILE = 'camera_profile.json'
+    cam = Camera(camSPI, camCS, fast_start=True, profile_file=CAMERA_PROFILE)
+    # 320x240 1280x720
+    cam.resolution = '1280x720'
+    # cam.resolution('1280x720')
+    cam.set_filter(cam.SPECIAL_REVERSE)
+    cam.set_brightness_level(cam.BRIGHTNESS_PLUS_4)
+    cam.set_contrast(cam.CONTRAST_MINUS_3)
+
+    # PROTOCOL_LEGACY matches the deployed ESP32 firmware, PROTOCOL_FRAMED needs firmware that speaks linkproto
+    LINK_PROTOCOL = ESP32Relay.PROTOCOL_LEGACY
+    # True sends only SOI..EOI of each JPEG. None turns it on for the framed link and OFF for the legacy link,
+    # which then sends the whole FIFO, because the trailer and probe messages need ESP32 firmware that knows them
+    JPEG_FRAMING = None
+    FRAMED_LINK = LINK_PROTOCOL == ESP32Relay.PROTOCOL_FRAMED
+    # Set dual_core=False to read and send each message in turn on one core
+    relay = ESP32Relay(esp32SPI, esp32CS, cam.BUFFER_MAX_LENGTH, dual_core=True, link_protocol=LINK_PROTOCOL,
+                       jpeg_framing=JPEG_FRAMING, telemetry_every=30 if FRAMED_LINK else 0)
+
+    # Pick the chunk size for this resolution, bus clock and ESP32 buffer before streaming, framed link only
+    if FRAMED_LINK:
+        relay.calibrate_chunk_size(cam)
+    print(f"chunk size: {relay.buffer_length}")
+    if CAMERA_PROFILE not in uos.listdir():
+        cam.calibrate_write_pacing()
+        cam.save_profile(CAMERA_PROFILE)
+
+    # onboard_LED.on()
+    esp32CS.on()
+    # 0 captures as fast as possible with the next exposure overlapping the transfer, otherwise one frame per interval
+    FRAME_INTERVAL_MS = 0
+    # Frames taking longer than this on the link step the quality and then the resolution down, None to disable
+    LINK_BUDGET_MS = None
+    rate_controller = RateController(cam, max_ms=LINK_BUDGET_MS) if LINK_BUDGET_MS else None
+    # Check a 96x96 YUV frame every MOTION_CHECK_MS and only send a JPEG when something moved, 0 sends every frame
+    MOTION_CHECK_MS = 0
+    if EXTRA_CAMERA_CS_PINS:
+        cams = [cam]
+        for i in range(len(EXTRA_CAMERA_CS_PINS)):
+            # One profile per module, named after its CS pin
+            profile_file = 'camera_profile_{}.json'.format(EXTRA_CAMERA_CS_PINS[i])
+            extra_cam = Camera(camSPI, extra_camera_cs[i], fast_start=True, profile_file=profile_file)
+            extra_cam.resolution = '1280x720'
+            if profile_file not in uos.listdir():
+                extra_cam.calibrate_write_pacing()
+                extra_cam.save_profile(profile_file)
+            # Chunks must fit the relay's buffers, which were sized by calibrate_chunk_size()
+            extra_cam.set_burst_length(relay.buffer_length)
+            cams.append(extra_cam)
+        frame_stream = MultiCamera(cams).relay_pipelined(relay)
+    elif MOTION_CHECK_MS:
+        frame_stream = MotionGate(cam, still='1280x720').relay(relay, FrameScheduler(MOTION_CHECK_MS))
+    elif FRAME_INTERVAL_MS:
+        frame_stream = relay.stream_scheduled(cam, FrameScheduler(FRAME_INTERVAL_MS))
+    else:
+        frame_stream = relay.stream_pipelined(cam)
+
+    # Telemetry is printed every REPORT_EVERY frames and sent to the ESP32 every 30 on the framed link, printing each frame slows the loop
+    REPORT_EVERY = 100
+    for frame_count, image_bytes in enumerate(frame_stream):
+        if rate_controller is not None and not EXTRA_CAMERA_CS_PINS:
+            rate_controller.update(image_bytes, relay.link_write_us)
+        if (frame_count + 1) % REPORT_EVERY == 0:
+            default_telemetry.report()
@@ -0,0 +1,486 @@
+import time
+import os
+import json
+import random
+
+import linkproto
+
+'''
+Simulated board for running picoCam on host CPython
+* Pin, SPI, reset and lightsleep stand in for machine, utime, uos and ujson for the MicroPython modules
+* Devices are attached to a bus id and the CS pin that selects them, board has an ArduCam Mega on
+  SPI 0 / Pin 17 and an ESP32 on SPI 1 / Pin 13 like the wiring at the bottom of picoCam.py
+* Each SPI transfer takes len / bandwidth seconds of real time, so measured throughput follows the bus
+
+    import simcam
+    simcam.board.attach(0, 17, simcam.SimArduCam(jpeg_files=['frame.jpg'], capture_latency_ms=80))
+    import picoCam
+'''
+
+
+class _UTime:
+    def __init__(self):
+        self._t0 = time.perf_counter()
+
+    def ticks_ms(self):
+        return int((time.perf_counter() - self._t0) * 1000)
+
+    def ticks_us(self):
+        return int((time.perf_counter() - self._t0) * 1000000)
+
+    def ticks_diff(self, end, start):
+        return end - start
+
+    def ticks_add(self, ticks, delta):
+        return ticks + delta
+
+    def sleep_ms(self, ms):
+        time.sleep(ms / 1000)
+
+    def sleep_us(self, us):
+        time.sleep(us / 1000000)
+
+utime = _UTime()
+uos = os
+ujson = json
+
+
+def reset():
+    pass
+
+
+def lightsleep(ms=None):
+    if ms is not None:
+        time.sleep(ms / 1000)
+
+
+'''
+Sensor model of the ArduCam Mega register map
+* CAM_REG_SENSOR_ID (0x40) returns sensor_id, CAM_REG_SENSOR_STATE / ARDUCHIP_TRIG (0x44) reports busy
+  for write_busy_us after each register write and CAP_DONE once capture_latency_ms has passed
+* ARDUCHIP_FIFO (0x04) 0x01 clears the done flag, 0x02 starts a capture. FIFO_SIZE1..3 hold the length
+* The FIFO is the next file of jpeg_files (round robin) followed by fifo_padding zeros, without files a
+  synthetic JPEG is generated with a size that scales with the resolution and image quality registers
+* With the format register set to RGB565 or YUV the FIFO is a raw frame of two bytes per pixel instead,
+  pixel (x, y) of RGB565 is (x + 256 * y) & 0xFFFF high byte first, YUV has Y = x + y
+* capture_latency_ms is a number or a dict of resolution register value -> ms
+* Register reads auto increment the address when auto_increment is set
+'''
+class SimArduCam:
+    CAM_REG_FIFO = 0x04
+    CAM_REG_SENSOR_RESET = 0x07
+    CAM_REG_FORMAT = 0x20
+    CAM_REG_CAPTURE_RESOLUTION = 0x21
+    CAM_REG_IMAGE_QUALITY = 0x2A
+    CAM_REG_SENSOR_ID = 0x40
+    CAM_REG_SENSOR_STATE = 0x44
+    FIFO_SIZE1 = 0x45
+
+    SINGLE_FIFO_READ = 0x3D
+    BURST_FIFO_READ = 0x3C
+
+    STATE_BUSY = 0x01
+    STATE_IDLE = 0x02
+    CAP_DONE_MASK = 0x04
+
+    SENSOR_3MP = 0x82
+    SENSOR_5MP = 0x81
+
+    # Resolution register value -> (width, height)
+    RESOLUTION_SIZES = {
+        0x00: (160, 120),
+        0x01: (320, 240),
+        0x02: (640, 480),
+        0x03: (800, 600),
+        0x04: (1280, 720),
+        0x05: (1280, 960),
+        0x06: (1600, 1200),
+        0x07: (1920, 1080),
+        0x08: (2048, 1536),
+        0x09: (2592, 1944),
+        0x0a: (96, 96),
+        0x0b: (128, 128),
+        0x0c: (320, 320)
+    }
+
+    # Synthetic JPEGs compress to about this many bits per pixel
+    SYNTHETIC_BITS_PER_PIXEL = 1.5
+    # Image quality register value -> size relative to high quality
+    QUALITY_SCALE = {0: 1.0, 1: 0.65, 2: 0.45}
+    FORMAT_RGB565 = 0x02
+    FORMAT_YUV = 0x03
+    RAW_FORMATS = (FORMAT_RGB565, FORMAT_YUV)
+
+    def __init__(self, jpeg_files=None, sensor_id=SENSOR_3MP, capture_latency_ms=None, write_busy_us=100,
+                 fifo_padding=16, auto_increment=True, seed=0):
+        self.jpeg_files = jpeg_files
+        self.sensor_id = sensor_id
+        self.capture_latency_ms = capture_latency_ms
+        self.write_busy_us = write_busy_us
+        self.fifo_padding = fifo_padding
+        self.auto_increment = auto_increment
+        self._random = random.Random(seed)
+
+        self.registers = {self.CAM_REG_CAPTURE_RESOLUTION: 0x02, self.CAM_REG_FORMAT: 0x01}
+        self.fifo = b''
+        self.fifo_position = 0
+        self.captures = 0
+        self.register_writes = 0
+        self._file_index = 0
+        self._synthetic = {}
+        self._busy_until = 0
+        self._capture_done_at = None
+        self._first_burst = True
+
+        self._mode = None
+        self._address = 0
+        self._dummy = False
+
+    def select(self):
+        self._mode = None
+
+    def deselect(self):
+        self._mode = None
+
+    def write(self, data):
+        for byte in data:
+            if self._mode is None:
+                self._command(byte)
+            elif self._mode == 'write':
+                self._write_register(self._address, byte)
+                self._mode = 'done'
+
+    def readinto(self, buffer, write=0):
+        length = len(buffer)
+        if self._mode == 'burst':
+            start = 0
+            if self._first_burst and length:
+                self._first_burst = False
+                buffer[0] = 0
+                start = 1
+            end = self.fifo_position + length - start
+            data = self.fifo[self.fifo_position:end]
+            buffer[start:start + len(data)] = data
+            for i in range(start + len(data), length):
+                buffer[i] = 0
+            self.fifo_position = end
+            return
+        for i in range(length):
+            buffer[i] = self._next_byte()
+
+    def read(self, count, write=0):
+        buffer = bytearray(count)
+        self.readinto(buffer, write)
+        return bytes(buffer)
+
+    def _command(self, byte):
+        self._dummy = True
+        if byte == self.BURST_FIFO_READ:
+            self._mode = 'burst'
+        elif byte == self.SINGLE_FIFO_READ:
+            self._mode = 'single'
+        elif byte & 0x80:
+            self._mode = 'write'
+            self._address = byte & 0x7F
+        else:
+            self._mode = 'read'
+            self._address = byte
+
+    def _next_byte(self):
+        if self._dummy:
+            self._dummy = False
+            return 0
+        if self._mode == 'single':
+            self._dummy = True
+            return self._fifo_byte()
+        if self._mode == 'read':
+            value = self._read_register(self._address)
+            if self.auto_increment:
+                self._address = (self._address + 1) & 0x7F
+            return value
+        return 0
+
+    def _fifo_byte(self):
+        if self.fifo_position >= len(self.fifo):
+            return 0
+        byte = self.fifo[self.fifo_position]
+        self.fifo_position += 1
+        return byte
+
+    def _read_register(self, address):
+        if address == self.CAM_REG_SENSOR_ID:
+            return self.sensor_id
+        if address == self.CAM_REG_SENSOR_STATE:
+            now = time.perf_counter()
+            state = self.STATE_BUSY if now < self._busy_until else self.STATE_IDLE
+            if self._capture_done_at is not None and now >= self._capture_done_at:
+                state |= self.CAP_DONE_MASK
+            return state
+        if self.FIFO_SIZE1 <= address <= self.FIFO_SIZE1 + 2:
+            if self._capture_done_at is None or time.perf_counter() < self._capture_done_at:
+                return 0
+            return (len(self.fifo) >> (8 * (address - self.FIFO_SIZE1))) & 0xFF
+        return self.registers.get(address, 0)
+
+    def _write_register(self, address, value):
+        self.register_writes += 1
+        self.registers[address] = value
+        now = time.perf_counter()
+        self._busy_until = now + self.write_busy_us / 1000000
+        if address == self.CAM_REG_FIFO:
+            if value == 0x01:
+                self._capture_done_at = None
+            elif value == 0x02:
+                self._start_capture(now)
+
+    def _start_capture(self, now):
+        self.captures += 1
+        self.fifo = self.next_image() + bytes(self.fifo_padding)
+        self.fifo_position = 0
+        self._first_burst = True
+        self._capture_done_at = now + self.capture_time_ms() / 1000
+
+    def capture_time_ms(self):
+        latency = self.capture_latency_ms
+        if latency is None:
+            # Roughly one frame period of the sensor plus JPEG encoding
+            width, height = self.resolution_size()
+            return 20 + width * height / 40000
+        if isinstance(latency, dict):
+            return latency.get(self.registers[self.CAM_REG_CAPTURE_RESOLUTION], 0)
+        return latency
+
+    def resolution_size(self):
+        return self.RESOLUTION_SIZES.get(self.registers[self.CAM_REG_CAPTURE_RESOLUTION], (640, 480))
+
+    def next_image(self):
+        if self.registers[self.CAM_REG_FORMAT] in self.RAW_FORMATS:
+            return self.synthetic_raw()
+        if self.jpeg_files:
+            path = self.jpeg_files[self._file_index % len(self.jpeg_files)]
+            self._file_index += 1
+            with open(path, 'rb') as f:
+                return f.read()
+
+        key = (self.registers[self.CAM_REG_CAPTURE_RESOLUTION], self.registers.get(self.CAM_REG_IMAGE_QUALITY, 0))
+        if key not in self._synthetic:
+            width, height = self.resolution_size()
+            scale = self.QUALITY_SCALE.get(key[1], 1.0)
+            self._synthetic[key] = self.synthetic_jpeg(int(width * height * self.SYNTHETIC_BITS_PER_PIXEL / 8 * scale))
+        return self._synthetic[key]
+
+    # SOI, an APP0 segment and entropy coded filler without markers, then EOI
+    def synthetic_raw(self):
+        width, height = self.resolution_size()
+        raw = bytearray(width * height * 2)
+        yuv = self.registers[self.CAM_REG_FORMAT] == self.FORMAT_YUV
+        for y in range(height):
+            for x in range(width):
+                index = 2 * (y * width + x)
+                if yuv:
+                    raw[index] = (x + y) & 0xFF
+                    raw[index + 1] = 0x80
+                else:
+                    value = (x + 256 * y) & 0xFFFF
+                    raw[index] = value >> 8
+                    raw[index + 1] = value & 0xFF
+        return bytes(raw)
+
+    def synthetic_jpeg(self, length):
+        header = b'\xff\xd8\xff\xe0\x00\x10JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00'
+        body_length = max(0, length - len(header) - 2)
+        body = self._random.getrandbits(8 * body_length).to_bytes(body_length, 'little').replace(b'\xff', b'\x00')
+        return header + body + b'\xff\xd9'
+
+
+'''
+ESP32 receiver model
+* protocol=linkproto.VERSION answers with linkproto.LinkReceiver, complete images are in frames,
+  max_chunk_size models the ESP32's DMA buffer
+* protocol=0 is the legacy handshake: 222 is clocked back to metadata and probe messages unless busy_polls
+  are left, raw data is collected per frame and cut to the length in the trailer message (or the metadata
+  length when the next metadata message arrives without a trailer)
+'''
+class SimESP32:
+    HANDSHAKE_ACK = 222
+    METADATA_MAGIC = (222, 22)
+    TRAILER_MAGIC = (222, 23)
+    PROBE_MAGIC = (222, 21)
+
+    def __init__(self, protocol=linkproto.VERSION, max_frames=8, busy_polls=0, max_chunk_size=None):
+        self.protocol = protocol
+        self.max_frames = max_frames
+        self.busy_polls = busy_polls
+        self.receiver = linkproto.LinkReceiver(max_frames, max_chunk_size)
+        self._frames = []
+        self._data = bytearray()
+        self._expected_length = 0
+        self._transaction = None
+
+    @property
+    def frames(self):
+        if self.protocol:
+            return self.receiver.frames
+        return self._frames
+
+    def select(self):
+        self._transaction = bytearray()
+
+    def deselect(self):
+        transaction = self._transaction
+        self._transaction = None
+        if self.protocol or not transaction:
+            return
+        if self._is_message(transaction, self.METADATA_MAGIC):
+            if self._data:
+                self._add_frame(bytes(self._data[:self._expected_length]))
+            self._expected_length = int.from_bytes(transaction[0:4], 'big')
+        elif self._is_message(transaction, self.TRAILER_MAGIC):
+            self._add_frame(bytes(self._data[:int.from_bytes(transaction[0:4], 'big')]))
+        elif not self._is_message(transaction, self.PROBE_MAGIC):
+            self._data += transaction
+
+    def write(self, data):
+        self._transaction += data
+
+    def readinto(self, buffer, write=0):
+        for i in range(len(buffer)):
+            buffer[i] = 0
+
+    def write_readinto(self, data, buffer):
+        if self.protocol:
+            buffer[:] = self.receiver.exchange(data)[:len(buffer)]
+            return
+
+        # Metadata and probe messages are repeated within one CS frame until the ACK
+        if self._is_message(data, self.METADATA_MAGIC):
+            self._transaction = bytearray(data)
+        ack = self.HANDSHAKE_ACK
+        if self.busy_polls > 0:
+            self.busy_polls -= 1
+            ack = 0
+        for i in range(len(buffer)):
+            buffer[i] = ack
+
+    def _is_message(self, data, magic):
+        return len(data) >= 8 and data[-2] == magic[0] and data[-1] == magic[1]
+
+    def _add_frame(self, image):
+        self._data = bytearray()
+        self._frames.append(image)
+        if len(self._frames) > self.max_frames:
+            self._frames.pop(0)
+
+
+'''
+Devices by CS pin and the device each bus currently has selected
+'''
+class Board:
+    def __init__(self):
+        self.devices = {}
+        self.selected = {}
+
+    def attach(self, bus_id, cs_pin, device):
+        self.devices[cs_pin] = (bus_id, device)
+        return device
+
+    def device(self, cs_pin):
+        return self.devices[cs_pin][1]
+
+    def _select(self, cs_pin, active):
+        if cs_pin not in self.devices:
+            return
+        bus_id, device = self.devices[cs_pin]
+        if active:
+            self.selected[bus_id] = device
+            device.select()
+        elif self.selected.get(bus_id) is device:
+            self.selected[bus_id] = None
+            device.deselect()
+
+board = Board()
+board.attach(0, 17, SimArduCam())
+# Legacy handshake like LINK_PROTOCOL at the bottom of picoCam.py, attach SimESP32() for the framed protocol
+board.attach(1, 13, SimESP32(protocol=0))
+
+
+class Pin:
+    IN = 0
+    OUT = 1
+    PULL_UP = 2
+    PULL_DOWN = 3
+
+    def __init__(self, pin_id, mode=IN, pull=None, value=None):
+        self.pin_id = pin_id
+        self._value = 1
+        if value is not None:
+            self.value(value)
+
+    def value(self, value=None):
+        if value is None:
+            return self._value
+        value = 1 if value else 0
+        if value != self._value:
+            self._value = value
+            board._select(self.pin_id, value == 0)
+
+    def on(self):
+        self.value(1)
+
+    def off(self):
+        self.value(0)
+
+    high = on
+    low = off
+    __call__ = value
+
+    def toggle(self):
+        self.value(not self._value)
+
+
+'''
+SPI bus, transfers go to the device selected on this bus id
+* bandwidth (bytes/s) defaults to baudrate / 8, transfers sleep once the owed time passes SLEEP_GRANULARITY_S
+* call_overhead_us is added to every call, the per transaction cost that makes small chunks slow on the board
+'''
+class SPI:
+    SLEEP_GRANULARITY_S = 0.0005
+
+    def __init__(self, bus_id, baudrate=1000000, polarity=0, phase=0, bits=8, sck=None, mosi=None, miso=None, bandwidth=None,
+                 call_overhead_us=0):
+        self.bus_id = bus_id
+        self.baudrate = baudrate
+        self.bandwidth = bandwidth if bandwidth is not None else baudrate / 8
+        self.call_overhead_s = call_overhead_us / 1000000
+        self.bytes_transferred = 0
+        self._due = 0
+
+    def write(self, data):
+        device = board.selected.get(self.bus_id)
+        if device is not None:
+            device.write(data)
+        self._clock(len(data))
+
+    def readinto(self, buffer, write=0):
+        device = board.selected.get(self.bus_id)
+        if device is not None:
+            device.readinto(buffer, write)
+        self._clock(len(buffer))
+
+    def read(self, count, write=0):
+        buffer = bytearray(count)
+        self.readinto(buffer, write)
+        return bytes(buffer)
+
+    def write_readinto(self, data, buffer):
+        device = board.selected.get(self.bus_id)
+        if device is not None:
+            device.write_readinto(data, buffer)
+        self._clock(len(data))
+
+    def _clock(self, count):
+        self.bytes_transferred += count
+        now = time.perf_counter()
+        self._due = max(self._due, now) + count / self.bandwidth + self.call_overhead_s
+        if self._due - now > self.SLEEP_GRANULARITY_S:
+            time.sleep(self._due - now)